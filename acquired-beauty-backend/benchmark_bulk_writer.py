@@ -0,0 +1,174 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SCRAPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sephora-scraper.py")
+
+COLUMNS = ['brand', 'name', 'link', 'type', 'image', 'price', 'rating']
+
+class PostgrestStandIn(BaseHTTPRequestHandler):
+    """
+    Just enough of PostgREST to take upserts into sephoraproducts: rows land in
+    SQLite with the same UNIQUE(link) and VARCHAR(255) limits as the real
+    table, and a bad row or a repeated link rejects the whole request.
+    """
+
+    database = None
+    lock = threading.Lock()
+    latency = 0.0
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        rows = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        rows = rows if isinstance(rows, list) else [rows]
+        on_conflict = parse_qs(urlparse(self.path).query).get('on_conflict', ['link'])[0]
+        time.sleep(self.latency)
+
+        with self.lock:
+            PostgrestStandIn.requests += 1
+            links = [row.get(on_conflict) for row in rows]
+            if len(set(links)) < len(links):
+                self.send_json(400, {'code': '21000', 'message': 'ON CONFLICT DO UPDATE command cannot affect row a second time',
+                                     'details': None, 'hint': None})
+                return
+            try:
+                with self.database:
+                    self.database.executemany(
+                        f"INSERT INTO sephoraproducts ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))}) "
+                        f"ON CONFLICT({on_conflict}) DO UPDATE SET "
+                        + ', '.join(f"{c} = excluded.{c}" for c in COLUMNS if c != on_conflict),
+                        [tuple(row.get(c) for c in COLUMNS) for row in rows]
+                    )
+            except sqlite3.IntegrityError as e:
+                self.send_json(400, {'code': '22001', 'message': str(e), 'details': None, 'hint': None})
+                return
+        self.send_json(201)
+
+def start_stand_in(latency):
+    database = sqlite3.connect(':memory:', check_same_thread=False)
+    database.execute(
+        """
+        CREATE TABLE sephoraproducts (
+            id INTEGER PRIMARY KEY,
+            brand TEXT CHECK (length(brand) <= 255),
+            name TEXT CHECK (length(name) <= 255),
+            link TEXT UNIQUE CHECK (length(link) <= 255),
+            type TEXT,
+            image TEXT,
+            price NUMERIC,
+            rating NUMERIC
+        )
+        """
+    )
+    PostgrestStandIn.database = database
+    PostgrestStandIn.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PostgrestStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, database
+
+def make_rows(count, bad_rows, seed=7):
+    """Product rows shaped like store_products', with some duplicates and invalid rows"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        rows.append({
+            'brand': rng.choice(['Rare Beauty', 'NARS', 'Fenty Beauty', 'Saie', 'Benefit Cosmetics']),
+            'name': f"Blush {i}",
+            'link': f"https://www.sephora.com/product/blush-P{100000 + i}?skuId={2000000 + i}",
+            'type': 'Blush',
+            'image': f"https://www.sephora.com/productimages/sku/s{2000000 + i}-main-zoom.jpg",
+            'price': round(rng.uniform(10, 60), 2),
+            'rating': round(rng.uniform(3, 5), 1),
+        })
+    # Recrawled duplicates and rows the table rejects
+    rows.extend(dict(row, price=row['price'] + 1) for row in rng.sample(rows, count // 50))
+    for row in rng.sample(rows[:count], bad_rows):
+        row['name'] = 'x' * 300
+    return rows
+
+def legacy_store(client, rows, batch_size=10):
+    """The previous store_products loop, without its 1s sleeps between batches"""
+    successful = failed = 0
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        try:
+            client.table("sephoraproducts").upsert(batch, on_conflict="link").execute()
+            successful += len(batch)
+        except Exception:
+            for row in batch:
+                try:
+                    client.table("sephoraproducts").upsert(row, on_conflict="link").execute()
+                    successful += 1
+                except Exception:
+                    failed += 1
+    return successful, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the bulk product writer against 10-row batches')
+    parser.add_argument('--products', type=int, default=5000, help='Distinct products to write')
+    parser.add_argument('--bad-rows', type=int, default=5, help='Rows the table will reject')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Simulated round trip per request')
+    parser.add_argument('--concurrency', type=int, default=4, help='Bulk writer batches in flight')
+    args = parser.parse_args()
+
+    server, database = start_stand_in(args.latency_ms / 1000)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # Point the scraper at the stand-in before it creates its client
+    os.environ['NEXT_PUBLIC_SUPABASE_URL'] = base_url
+    os.environ['NEXT_PUBLIC_SUPABASE_ANON_KEY'] = 'stand-in'
+    spec = importlib.util.spec_from_file_location("sephora_scraper", SCRAPER_PATH)
+    scraper = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(scraper)
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    rows = make_rows(args.products, args.bad_rows)
+    print(f"Writing {len(rows)} rows ({args.products} distinct links, {args.bad_rows} invalid) "
+          f"with {args.latency_ms:.0f} ms simulated latency\n")
+
+    PostgrestStandIn.requests = 0
+    start = time.perf_counter()
+    successful, failed = legacy_store(scraper.supabase, rows)
+    legacy_seconds = time.perf_counter() - start
+    legacy_sleep = len(range(0, len(rows), 10)) - 1
+    print(f"  10-row batches   {legacy_seconds:8.2f}s (+{legacy_sleep}s of sleeps)  "
+          f"{PostgrestStandIn.requests:6} requests  {successful} ok / {failed} failed")
+
+    database.execute("DELETE FROM sephoraproducts")
+    database.commit()
+    PostgrestStandIn.requests = 0
+    start = time.perf_counter()
+    writer = scraper.BulkWriter("sephoraproducts", on_conflict="link", client=scraper.supabase,
+                                concurrency=args.concurrency)
+    successful, failed = writer.write(rows)
+    bulk_seconds = time.perf_counter() - start
+    print(f"  BulkWriter       {bulk_seconds:8.2f}s{'':22}{PostgrestStandIn.requests:6} requests  "
+          f"{successful} ok / {failed} failed")
+
+    stored = database.execute("SELECT count(*) FROM sephoraproducts").fetchone()[0]
+    print(f"\nRows in table: {stored}; final batch size {writer.batch_bytes // 1024} KiB")
+    print(f"Speedup: {legacy_seconds / bulk_seconds:.1f}x ignoring the old sleeps, "
+          f"{(legacy_seconds + legacy_sleep) / bulk_seconds:.1f}x including them")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
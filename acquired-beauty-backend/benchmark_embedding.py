@@ -0,0 +1,212 @@
+import argparse
+import logging
+import random
+import time
+from typing import List
+import numpy as np
+from server import (
+    QuizResult,
+    CompiledEncoder,
+    generate_semantic_embedding,
+    VECTOR_SIZE,
+    FEATURE_WEIGHTS,
+    SKIN_TONE_MAPPING,
+    UNDERTONE_MAPPING,
+    COVERAGE_MAPPING,
+    SKIN_TYPE_MAPPING,
+    LIP_PRODUCT_MAPPING,
+    MAKEUP_STYLE_MAPPING,
+    MAKEUP_FREQUENCY_MAPPING,
+    CONCERN_MAPPING,
+)
+
+# The legacy encoder logged through the server's logger; --verbose-logging keeps it on
+logger = logging.getLogger('server')
+
+def legacy_generate_semantic_embedding(quiz_result: QuizResult) -> List[float]:
+    """
+    The original per-request implementation of server.generate_semantic_embedding,
+    kept here as the reference the compiled encoder is checked and timed against.
+    """
+    # Initialize a zero vector
+    embedding = np.zeros(VECTOR_SIZE)
+    
+    # Helper function to fill a section of the embedding
+    def fill_section(start_idx, values, weight=1.0):
+        if values is None:
+            return False
+        
+        length = len(values)
+        embedding[start_idx:start_idx+length] = np.array(values) * weight
+        return True
+    
+    # Extract and map skin tone information
+    skin_tone_idx = 0
+    skin_tone = quiz_result.skin_tone.lower()
+    if skin_tone in SKIN_TONE_MAPPING:
+        embedding[skin_tone_idx:skin_tone_idx+6] = np.array(SKIN_TONE_MAPPING[skin_tone]) * FEATURE_WEIGHTS.get('skin_tone', 1.0)
+        logger.info(f"Set skin tone: {skin_tone}")
+    
+    # Extract and map undertone information
+    undertone_idx = 10
+    undertone = quiz_result.under_tone.lower()
+    if undertone in UNDERTONE_MAPPING:
+        embedding[undertone_idx:undertone_idx+3] = np.array(UNDERTONE_MAPPING[undertone]) * FEATURE_WEIGHTS.get('under_tone', 1.0)
+        logger.info(f"Set undertone: {undertone}")
+    
+    # Extract and map coverage information
+    coverage_idx = 20
+    coverage = quiz_result.coverage_level.lower()
+    if coverage in COVERAGE_MAPPING:
+        embedding[coverage_idx:coverage_idx+3] = np.array(COVERAGE_MAPPING[coverage]) * FEATURE_WEIGHTS.get('coverage_level', 1.0)
+        logger.info(f"Set coverage level: {coverage}")
+    
+    # Extract and map skin type information
+    skin_type_idx = 30
+    skin_type = quiz_result.skin_type.lower()
+    if skin_type in SKIN_TYPE_MAPPING:
+        embedding[skin_type_idx:skin_type_idx+4] = np.array(SKIN_TYPE_MAPPING[skin_type]) * FEATURE_WEIGHTS.get('skin_type', 1.0)
+        logger.info(f"Set skin type: {skin_type}")
+    
+    # Extract concerns/restrictions
+    concerns_idx = 40
+    if quiz_result.restrictions:
+        concern_vec = np.zeros(6)  # 6 possible concerns in quiz
+        concerns = quiz_result.restrictions.split(',')
+        
+        # Map concerns to vector positions
+        concern_mapping = {
+            'acne': 0, 'aging': 1, 'dark-spots': 2, 
+            'redness': 3, 'pores': 4, 'texture': 5
+        }
+        
+        for concern in concerns:
+            concern = concern.strip().lower()
+            if concern in concern_mapping:
+                concern_vec[concern_mapping[concern]] = 1.0
+                logger.info(f"Added concern: {concern}")
+        
+        embedding[concerns_idx:concerns_idx+6] = concern_vec * FEATURE_WEIGHTS.get('restrictions', 1.0)
+    
+    # Extract lip product preference
+    lip_idx = 50
+    lip_mapping = {
+        'lipstick': [1.0, 0.0, 0.0, 0.0],
+        'gloss': [0.0, 1.0, 0.0, 0.0],
+        'stain': [0.0, 0.0, 1.0, 0.0],
+        'balm': [0.0, 0.0, 0.0, 1.0]
+    }
+    lip_product = quiz_result.lip_product.lower()
+    if lip_product in lip_mapping:
+        embedding[lip_idx:lip_idx+4] = np.array(lip_mapping[lip_product]) * FEATURE_WEIGHTS.get('lip_product', 0.5)
+        logger.info(f"Set lip product: {lip_product}")
+    
+    # Extract makeup style
+    style_idx = 60
+    style_mapping = {
+        'natural': [1.0, 0.0, 0.0, 0.0],
+        'minimal': [0.7, 0.3, 0.0, 0.0],
+        'glam': [0.0, 0.0, 1.0, 0.0],
+        'experimental': [0.0, 0.0, 0.0, 1.0]
+    }
+    makeup_style = quiz_result.makeup_style.lower()
+    if makeup_style in style_mapping:
+        embedding[style_idx:style_idx+4] = np.array(style_mapping[makeup_style]) * FEATURE_WEIGHTS.get('makeup_style', 0.8)
+        logger.info(f"Set makeup style: {makeup_style}")
+    
+    # Extract makeup frequency
+    freq_idx = 70
+    freq_mapping = {
+        'daily': [1.0, 0.0, 0.0, 0.0],
+        'few-times': [0.0, 1.0, 0.0, 0.0],
+        'occasionally': [0.0, 0.0, 1.0, 0.0],
+        'rarely': [0.0, 0.0, 0.0, 1.0]
+    }
+    frequency = quiz_result.makeup_frequency.lower()
+    if frequency in freq_mapping:
+        embedding[freq_idx:freq_idx+4] = np.array(freq_mapping[frequency]) * FEATURE_WEIGHTS.get('makeup_frequency', 0.5)
+        logger.info(f"Set makeup frequency: {frequency}")
+    
+    # Normalize the embedding
+    norm = np.linalg.norm(embedding)
+    if norm > 0:
+        embedding = embedding / norm
+    
+    # Log some stats about the embedding
+    num_nonzero = np.count_nonzero(embedding)
+    logger.info(f"Generated embedding with {num_nonzero} non-zero values out of {VECTOR_SIZE}")
+    logger.info(f"First 10 values: {embedding[:10]}")
+    
+    return embedding.tolist()
+
+def random_quiz_results(count, seed=42):
+    """Build a reproducible list of quiz answers, including some unknown values"""
+    rng = random.Random(seed)
+    concerns = list(CONCERN_MAPPING)
+
+    def pick(mapping):
+        return rng.choice(list(mapping) + ['', 'Unknown'])
+
+    results = []
+    for _ in range(count):
+        results.append(QuizResult(
+            skin_tone=pick(SKIN_TONE_MAPPING).title(),
+            under_tone=pick(UNDERTONE_MAPPING),
+            coverage_level=pick(COVERAGE_MAPPING),
+            skin_type=pick(SKIN_TYPE_MAPPING),
+            restrictions=','.join(rng.sample(concerns, rng.randint(0, 3))),
+            lip_product=pick(LIP_PRODUCT_MAPPING),
+            makeup_style=pick(MAKEUP_STYLE_MAPPING),
+            makeup_frequency=pick(MAKEUP_FREQUENCY_MAPPING),
+        ))
+    return results
+
+def time_encoder(name, encode, quiz_results, repeat):
+    """Run an encoder over every quiz result `repeat` times and report per-call cost"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for quiz_result in quiz_results:
+            encode(quiz_result)
+    elapsed = time.perf_counter() - start
+    calls = repeat * len(quiz_results)
+    print(f"  {name:<28} {elapsed * 1e6 / calls:10.2f} us/call  ({calls} calls, {elapsed:.3f}s)")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the compiled quiz encoder against the legacy implementation')
+    parser.add_argument('--samples', type=int, default=1000, help='Number of distinct quiz results')
+    parser.add_argument('--repeat', type=int, default=20, help='Passes over the samples')
+    parser.add_argument('--verbose-logging', action='store_true',
+                        help='Keep INFO logging on (the legacy encoder logs every field)')
+    args = parser.parse_args()
+
+    if not args.verbose_logging:
+        logging.getLogger('server').setLevel(logging.WARNING)
+
+    quiz_results = random_quiz_results(args.samples)
+
+    # Both encoders must agree before their timings mean anything
+    for quiz_result in quiz_results:
+        expected = legacy_generate_semantic_embedding(quiz_result)
+        actual = generate_semantic_embedding(quiz_result)
+        if not np.allclose(expected, actual):
+            raise AssertionError(f"Encoders disagree for {quiz_result.model_dump()}")
+    print(f"Verified encoders agree on {len(quiz_results)} quiz results\n")
+
+    print("Encoding time:")
+    legacy = time_encoder('legacy', legacy_generate_semantic_embedding, quiz_results, args.repeat)
+
+    uncached = CompiledEncoder(cache_size=0)
+    cold = time_encoder('compiled (no memo)', uncached.encode, quiz_results, args.repeat)
+
+    cached = CompiledEncoder()
+    warm = time_encoder('compiled (memoized)', cached.encode, quiz_results, args.repeat)
+    listed = time_encoder('generate_semantic_embedding', generate_semantic_embedding, quiz_results, args.repeat)
+
+    print(f"\nSpeedup vs legacy: no memo {legacy / cold:.1f}x, "
+          f"memoized {legacy / warm:.1f}x, "
+          f"with list conversion {legacy / listed:.1f}x")
+    print(f"Memo stats: {cached.encode_key.cache_info()}")
+
+if __name__ == "__main__":
+    main()
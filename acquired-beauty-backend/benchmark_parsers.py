@@ -0,0 +1,98 @@
+import argparse
+import glob
+import gzip
+import importlib.util
+import logging
+import os
+import statistics
+import time
+
+SCRAPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sephora-scraper.py")
+# Pages sampled by the scraper's debug capture: <root>/<run>/<category>/page-<hash>.html.gz
+CAPTURE_ROOT = os.getenv("SCRAPER_DEBUG_DIR", os.path.join(os.path.dirname(SCRAPER_PATH), "debug_output"))
+
+def load_scraper():
+    """Import sephora-scraper.py, whose file name is not a valid module name"""
+    spec = importlib.util.spec_from_file_location("sephora_scraper", SCRAPER_PATH)
+    scraper = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(scraper)
+    return scraper
+
+def read_page(path):
+    """HTML of a saved page, gzipped like the debug captures or plain"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return f.read()
+
+def page_label(path):
+    """Category directory and file name, since capture file names are content hashes"""
+    return os.path.join(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+
+def time_call(func, repeat):
+    """Median wall time of `repeat` calls, plus the last result"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+def benchmark_page(scraper, html_content, backend, repeat):
+    """Time parsing a page and extracting its JSON-LD and grid products with one backend"""
+    parse_seconds, document = time_call(lambda: scraper.parse_document(html_content, backend), repeat)
+
+    def extract():
+        json_ld_products = scraper.extract_json_ld_products(document)
+        _, grid_products = scraper.extract_grid_products(document, 1)
+        return json_ld_products, grid_products
+
+    extract_seconds, products = time_call(extract, repeat)
+    return parse_seconds, extract_seconds, products
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare HTML parser backends over saved Sephora pages')
+    parser.add_argument('--pages', default=os.path.join(CAPTURE_ROOT, '*', '*', 'page-*.html.gz'),
+                        help='Glob of saved category pages, .html or .html.gz '
+                             '(default: every page captured with --debug-sample)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per page and backend (median is reported)')
+    args = parser.parse_args()
+
+    scraper = load_scraper()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    paths = sorted(glob.glob(args.pages))
+    if not paths:
+        print(f"No pages match {args.pages}")
+        return
+
+    backends = list(scraper.PARSER_BACKENDS)
+    print(f"Backends: {', '.join(backends)} (default: {scraper.default_parser_backend()})\n")
+    print(f"{'page':<44} {'backend':<12} {'parse ms':>10} {'extract ms':>11} {'total ms':>10} {'products':>9}")
+
+    totals = {backend: 0.0 for backend in backends}
+    for path in paths:
+        html_content = read_page(path)
+
+        reference = None
+        for backend in backends:
+            parse_seconds, extract_seconds, products = benchmark_page(scraper, html_content, backend, args.repeat)
+            totals[backend] += parse_seconds + extract_seconds
+
+            # Every backend must extract exactly what the BeautifulSoup reference does
+            if reference is None:
+                reference = products
+            elif products != reference:
+                print(f"WARNING: {backend} extracted different products than {backends[0]} for {path}")
+
+            count = len(products[0]) + len(products[1])
+            print(f"{page_label(path):<44} {backend:<12} {parse_seconds * 1000:>10.2f} "
+                  f"{extract_seconds * 1000:>11.2f} {(parse_seconds + extract_seconds) * 1000:>10.2f} {count:>9}")
+
+    print("\nTotal per backend:")
+    baseline = totals[backends[0]]
+    for backend, seconds in totals.items():
+        print(f"  {backend:<12} {seconds * 1000:>10.2f} ms  ({baseline / seconds:.1f}x vs {backends[0]})")
+
+if __name__ == "__main__":
+    main()
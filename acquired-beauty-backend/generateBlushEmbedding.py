@@ -1,8 +1,14 @@
 import os
+import argparse
+import hashlib
+import pickle
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from sklearn.feature_extraction.text import TfidfVectorizer
+from urllib3.util.retry import Retry
 import time
 
 # Load environment variables
@@ -122,8 +128,161 @@ def insert_embedding(blush_id, embedding):
         print(f"Exception during embedding insert/update for product {blush_id}: {str(e)}")
         return False
 
-def generate_embeddings():
-    """Main function to generate and store embeddings"""
+# Bulk mode: embeddings per upsert request and requests in flight at once
+EMBEDDING_CHUNK_SIZE = int(os.getenv("EMBEDDING_CHUNK_SIZE", "200"))
+EMBEDDING_WRITE_WORKERS = int(os.getenv("EMBEDDING_WRITE_WORKERS", "4"))
+
+def create_bulk_session(pool_size=EMBEDDING_WRITE_WORKERS):
+    """Pooled session that retries throttled and failed upserts with backoff"""
+    session = requests.Session()
+    # Upserts on blush_id are idempotent, so POSTs are safe to retry
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(headers)
+    return session
+
+def upsert_embedding_chunk(session, rows):
+    """Insert or update a chunk of embeddings in one request"""
+    url = f"{SUPABASE_URL}rest/v1/blush_embeddings?on_conflict=blush_id"
+    upsert_headers = {"Prefer": "resolution=merge-duplicates,return=minimal"}
+    payload = json.dumps(rows)
+    response = session.post(url, headers=upsert_headers, data=payload, timeout=60)
+    if response.status_code not in [200, 201, 204]:
+        raise requests.HTTPError(f"{response.status_code}: {response.text[:200]}", response=response)
+    return len(payload)
+
+def bulk_upsert_embeddings(product_ids, embeddings, chunk_size=EMBEDDING_CHUNK_SIZE, workers=EMBEDDING_WRITE_WORKERS,
+                           failed_ids=None):
+    """
+    Upsert all embeddings in chunks of `chunk_size`, with up to `workers`
+    requests in flight over one pooled session.
+    Returns (success_count, failure_count); ids that failed are appended to
+    `failed_ids` if given.
+    """
+    session = create_bulk_session(workers)
+    success_count = 0
+    failure_count = 0
+    payload_bytes = 0
+    
+    def write_chunk(start):
+        # Densify one chunk at a time rather than the whole matrix
+        dense = embeddings[start:start + chunk_size].toarray().tolist()
+        rows = [{"blush_id": blush_id, "embedding": embedding}
+                for blush_id, embedding in zip(product_ids[start:start + chunk_size], dense)]
+        return len(rows), upsert_embedding_chunk(session, rows)
+    
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(write_chunk, start): start for start in range(0, len(product_ids), chunk_size)}
+        for future in as_completed(futures):
+            start = futures[future]
+            chunk_ids = product_ids[start:start + chunk_size]
+            try:
+                count, size = future.result()
+                success_count += count
+                payload_bytes += size
+                print(f"Upserted embeddings for products {chunk_ids[0]}..{chunk_ids[-1]} ({count} rows)")
+            except Exception as e:
+                failure_count += len(chunk_ids)
+                if failed_ids is not None:
+                    failed_ids.extend(chunk_ids)
+                print(f"Failed to upsert embeddings for products {chunk_ids[0]}..{chunk_ids[-1]}: {str(e)}")
+    elapsed = time.perf_counter() - start_time
+    session.close()
+    
+    chunk_count = -(-len(product_ids) // chunk_size)
+    print(f"Wrote {success_count} embeddings in {elapsed:.2f}s "
+          f"({success_count / elapsed if elapsed else 0:.1f} rows/s, {chunk_count} chunks, "
+          f"{payload_bytes / 1e6:.1f} MB, {workers} in flight)")
+    return success_count, failure_count
+
+# Incremental mode: fitted vectorizer and per-product text hashes from the last run
+EMBEDDING_STATE_PATH = os.getenv("EMBEDDING_STATE_PATH", "blush_embedding_state.pkl")
+# Refit the vocabulary when more than this share of the changed products' terms is unknown to it
+EMBEDDING_DRIFT_THRESHOLD = float(os.getenv("EMBEDDING_DRIFT_THRESHOLD", "0.1"))
+
+def product_text(product):
+    """Text representation of a product that its embedding is computed from"""
+    text_features = []
+    for key, value in product.items():
+        if value is not None and key not in ['id', 'price', 'rating', 'image', 'link']:
+            text_features.append(f"{key}: {value}")
+    return " ".join(text_features)
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def load_embedding_state(path):
+    """
+    State saved by the last run: {'version', 'vectorizer', 'hashes'} where
+    hashes maps product id -> hash of the text its stored embedding came from
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        print(f"Could not read embedding state {path}, refitting: {str(e)}")
+        return None
+
+def save_embedding_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, path)
+
+def vocabulary_drift(vectorizer, texts):
+    """Share of the terms in `texts` that the fitted vocabulary does not know"""
+    analyzer = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+    total = 0
+    unknown = 0
+    for text in texts:
+        for term in analyzer(text):
+            total += 1
+            if term not in vocabulary:
+                unknown += 1
+    return unknown / total if total else 0.0
+
+def notify_cache_invalidation():
+    """Tell the API server to drop cached embeddings and rebuild its recommendation index"""
+    backend_url = os.getenv("BACKEND_URL")
+    token = os.getenv("CACHE_INVALIDATE_TOKEN")
+    if not backend_url or not token:
+        print("BACKEND_URL or CACHE_INVALIDATE_TOKEN not set, skipping cache invalidation")
+        return False
+
+    try:
+        url = f"{backend_url.rstrip('/')}/cache/invalidate"
+        response = requests.post(url, headers={"Authorization": f"Bearer {token}"},
+                                 params={"scope": "product-embeddings"}, timeout=10)
+        if response.status_code == 200:
+            print(f"Invalidated API cache: {response.json()}")
+            return True
+        print(f"Cache invalidation failed: {response.status_code}")
+        print(f"Response: {response.text}")
+    except Exception as e:
+        print(f"Exception invalidating API cache: {str(e)}")
+    return False
+
+def generate_embeddings(bulk=True, chunk_size=EMBEDDING_CHUNK_SIZE, workers=EMBEDDING_WRITE_WORKERS,
+                        incremental=True, state_path=EMBEDDING_STATE_PATH, drift_threshold=EMBEDDING_DRIFT_THRESHOLD):
+    """
+    Main function to generate and store embeddings.
+    In incremental mode only products whose text changed since the last run
+    are embedded with the saved vectorizer and uploaded; the vectorizer is
+    refit, and everything uploaded, when the changed text drifts too far
+    from its vocabulary.
+    """
     print(f"Starting embedding generation with Supabase URL: {SUPABASE_URL}")
     
     # Check if the table exists
@@ -154,47 +313,103 @@ def generate_embeddings():
     product_ids = []
     
     for product in products:
-        # Extract relevant text fields for embedding
-        text_features = []
-        for key, value in product.items():
-            if value is not None and key not in ['id', 'price', 'rating', 'image', 'link']:
-                text_features.append(f"{key}: {value}")
-        
-        product_text = " ".join(text_features)
-        product_texts.append(product_text)
+        text = product_text(product)
+        product_texts.append(text)
         product_ids.append(product['id'])
+    
+    hashes = [content_hash(text) for text in product_texts]
+    
+    state = load_embedding_state(state_path) if incremental else None
+    if state is not None:
+        changed = [i for i, (product_id, text_hash) in enumerate(zip(product_ids, hashes))
+                   if state['hashes'].get(product_id) != text_hash]
+        print(f"{len(changed)} of {len(product_ids)} products changed since vocabulary version {state['version']}")
+        if not changed:
+            print("Embeddings are up to date")
+            return
         
-        print(f"Product {product['id']} - {product.get('name', 'Unnamed')}: {product_text[:100]}...")
+        drift = vocabulary_drift(state['vectorizer'], [product_texts[i] for i in changed])
+        print(f"Vocabulary drift of changed products: {drift:.1%} (threshold {drift_threshold:.1%})")
+        if drift > drift_threshold:
+            print("Drift above threshold, refitting the vocabulary")
+            state = {'version': state['version'] + 1, 'vectorizer': None, 'hashes': {}}
+    else:
+        previous = load_embedding_state(state_path)
+        state = {'version': previous['version'] + 1 if previous else 1, 'vectorizer': None, 'hashes': {}}
+        changed = range(len(product_ids))
+    
+    for i in changed:
+        print(f"Product {product_ids[i]} - {products[i].get('name', 'Unnamed')}: {product_texts[i][:100]}...")
     
     # Generate TF-IDF embeddings
     print("Generating embeddings...")
-    vectorizer = TfidfVectorizer()
-    embeddings = vectorizer.fit_transform(product_texts)
+    if state['vectorizer'] is None:
+        # A refit changes every embedding, so everything is uploaded
+        vectorizer = TfidfVectorizer()
+        embeddings = vectorizer.fit_transform(product_texts)
+        state['vectorizer'] = vectorizer
+        write_indexes = list(range(len(product_ids)))
+    else:
+        write_indexes = list(changed)
+        embeddings = state['vectorizer'].transform([product_texts[i] for i in write_indexes])
+    write_ids = [product_ids[i] for i in write_indexes]
     
-    print(f"Generated embeddings with shape: {embeddings.shape}")
+    print(f"Generated embeddings with shape: {embeddings.shape} (vocabulary version {state['version']})")
     
     # Insert embeddings into database
-    success_count = 0
-    failure_count = 0
-    
-    for i, product_id in enumerate(product_ids):
-        # Convert sparse vector to regular array and then to list
-        embedding = embeddings[i].toarray()[0].tolist()
-        
-        print(f"Processing product {product_id} with embedding of length {len(embedding)}")
+    failed_ids = []
+    if bulk:
+        success_count, failure_count = bulk_upsert_embeddings(write_ids, embeddings, chunk_size, workers, failed_ids)
+    else:
+        success_count = 0
+        failure_count = 0
+        start_time = time.perf_counter()
         
-        # Insert or update the embedding
-        if insert_embedding(product_id, embedding):
-            success_count += 1
-            print(f"Successfully processed product {product_id}")
-        else:
-            failure_count += 1
-            print(f"Failed to process product {product_id}")
+        for i, product_id in enumerate(write_ids):
+            # Convert sparse vector to regular array and then to list
+            embedding = embeddings[i].toarray()[0].tolist()
+            
+            print(f"Processing product {product_id} with embedding of length {len(embedding)}")
+            
+            # Insert or update the embedding
+            if insert_embedding(product_id, embedding):
+                success_count += 1
+                print(f"Successfully processed product {product_id}")
+            else:
+                failure_count += 1
+                failed_ids.append(product_id)
+                print(f"Failed to process product {product_id}")
+            
+            # Add a small delay between requests to avoid rate limiting
+            time.sleep(0.5)
         
-        # Add a small delay between requests to avoid rate limiting
-        time.sleep(0.5)
+        elapsed = time.perf_counter() - start_time
+        print(f"Wrote {success_count} embeddings in {elapsed:.2f}s ({success_count / elapsed if elapsed else 0:.1f} rows/s)")
     
     print(f"Embedding generation complete. Successes: {success_count}, Failures: {failure_count}")
+    
+    # Failed products keep their old hash so the next run retries them
+    failed = set(failed_ids)
+    for i in write_indexes:
+        if product_ids[i] not in failed:
+            state['hashes'][product_ids[i]] = hashes[i]
+    save_embedding_state(state_path, state)
+    
+    if success_count:
+        notify_cache_invalidation()
 
 if __name__ == "__main__":
-    generate_embeddings()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Generate blush embeddings and store them in Supabase')
+    parser.add_argument('--per-row', action='store_true',
+                        help='Write one product at a time (check, then update or insert) instead of bulk upserts')
+    parser.add_argument('--chunk-size', type=int, default=EMBEDDING_CHUNK_SIZE, help='Embeddings per upsert request')
+    parser.add_argument('--workers', type=int, default=EMBEDDING_WRITE_WORKERS, help='Upsert requests in flight')
+    parser.add_argument('--full', action='store_true',
+                        help='Refit the vocabulary and rewrite every embedding, ignoring saved state')
+    parser.add_argument('--state', default=EMBEDDING_STATE_PATH, help='Where the vectorizer and content hashes are kept')
+    parser.add_argument('--drift-threshold', type=float, default=EMBEDDING_DRIFT_THRESHOLD,
+                        help='Share of unknown terms in changed products that triggers a refit')
+    args = parser.parse_args()
+    
+    generate_embeddings(bulk=not args.per_row, chunk_size=args.chunk_size, workers=args.workers,
+                        incremental=not args.full, state_path=args.state, drift_threshold=args.drift_threshold)
\ No newline at end of file
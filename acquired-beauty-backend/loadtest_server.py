@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+async def run_level(client, url, concurrency, requests_per_worker):
+    """Fire `concurrency` workers at the URL at once and collect per-request latency"""
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for _ in range(requests_per_worker):
+            start = time.perf_counter()
+            try:
+                response = await client.get(url)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'mean': statistics.fmean(latencies) if latencies else 0.0,
+    }
+
+async def main_async(args):
+    url = args.base_url.rstrip('/') + args.path
+    limits = httpx.Limits(max_connections=max(args.levels), max_keepalive_connections=max(args.levels))
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        # Warm up connections and any server-side lazy loading
+        await run_level(client, url, 1, 3)
+
+        print(f"Load testing {url}")
+        print(f"{'conc':>6} {'reqs':>6} {'errs':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        results = []
+        for level in args.levels:
+            result = await run_level(client, url, level, args.requests)
+            results.append(result)
+            print(f"{result['concurrency']:>6} {result['requests']:>6} {result['errors']:>5} "
+                  f"{result['rps']:>9.1f} {result['p50']:>9.1f} {result['p95']:>9.1f} {result['p99']:>9.1f}")
+
+    # With a blocked event loop p99 grows roughly linearly with concurrency
+    baseline = results[0]['p99'] or 1.0
+    worst = max(results, key=lambda r: r['p99'])
+    print(f"\nWorst p99 is {worst['p99'] / baseline:.1f}x the p99 at concurrency {results[0]['concurrency']} "
+          f"(at concurrency {worst['concurrency']})")
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrency load test for the FastAPI backend')
+    parser.add_argument('--base-url', default='http://localhost:8000', help='Server to test')
+    parser.add_argument('--path', default='/products', help='Endpoint to hit, e.g. /product-embeddings')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 10, 50, 100],
+                        help='Concurrency levels to run, in order')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per worker at each level')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Per-request timeout in seconds')
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import os
+import re
+import gzip
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
 from supabase import create_client, Client
 import pandas as pd
+import matplotlib
+# Charts are only ever written to files, so never pick up an interactive backend
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from collections import Counter
 import argparse
 
 load_dotenv()
@@ -17,11 +24,175 @@ if not supabase_url or not supabase_key:
 
 supabase = create_client(supabase_url, supabase_key)
 
+# Rows per request when paging through the table
+SNAPSHOT_PAGE_SIZE = 1000
+# A cached snapshot is reused while younger than this and the table's row count and
+# newest id still match; rows updated in place are picked up when it expires
+SNAPSHOT_MAX_AGE_MINUTES = float(os.getenv("ANALYZER_SNAPSHOT_MAX_AGE", "60"))
+
+def table_fingerprint():
+    """Row count and newest id of the table, from two single-row requests"""
+    count = supabase.table("sephoraproducts").select("id", count="exact").limit(1).execute().count
+    newest = supabase.table("sephoraproducts").select("id").order("id", desc=True).limit(1).execute()
+    return {'count': count, 'max_id': newest.data[0]['id'] if newest.data else None}
+
+def iter_pages(page_size=SNAPSHOT_PAGE_SIZE):
+    """
+    Yield the table a page of rows at a time, ordered by id. Each request
+    continues after the last id seen, so pages neither overlap nor skip rows.
+    Paging stops at the first empty page rather than a short one, because
+    PostgREST's max-rows cap can return fewer rows than page_size mid-table.
+    """
+    last_id = None
+    while True:
+        query = supabase.table("sephoraproducts").select("*").order("id").limit(page_size)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        rows = query.execute().data
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+def coerce_numeric(df):
+    """PostgREST returns numeric columns as JSON numbers or strings"""
+    for column in ('price', 'rating'):
+        if column in df:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+def fetch_snapshot(page_size=SNAPSHOT_PAGE_SIZE):
+    """Page through the whole table once, by id, into a DataFrame"""
+    columns = {}
+    row_count = 0
+    for rows in iter_pages(page_size):
+        # Build columns as we go rather than holding every row dict
+        for row in rows:
+            for key in row:
+                if key not in columns:
+                    columns[key] = [None] * row_count
+            for key, values in columns.items():
+                values.append(row.get(key))
+            row_count += 1
+    
+    df = coerce_numeric(pd.DataFrame(columns))
+    print(f"Fetched snapshot of {len(df)} products")
+    return df
+
+def load_snapshot(cache_path=None, max_age_minutes=SNAPSHOT_MAX_AGE_MINUTES, refresh=False,
+                  page_size=SNAPSHOT_PAGE_SIZE):
+    """
+    The table as a DataFrame. With a cache path the snapshot is kept as
+    Parquet next to a small JSON record of when it was taken, and reused
+    while it is fresh.
+    """
+    meta_path = f"{cache_path}.json" if cache_path else None
+    if cache_path and not refresh and os.path.exists(cache_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            age_minutes = (time.time() - meta['fetched_at']) / 60
+            if age_minutes < max_age_minutes and table_fingerprint() == meta['fingerprint']:
+                df = pd.read_parquet(cache_path)
+                print(f"Using cached snapshot of {len(df)} products from {age_minutes:.0f} minutes ago")
+                return df
+        except Exception as e:
+            print(f"Ignoring cached snapshot: {e}")
+    
+    fingerprint = table_fingerprint() if cache_path else None
+    df = fetch_snapshot(page_size)
+    if cache_path:
+        try:
+            df.to_parquet(cache_path, index=False)
+            with open(meta_path, "w") as f:
+                json.dump({'fetched_at': time.time(), 'fingerprint': fingerprint}, f)
+        except Exception as e:
+            print(f"Could not cache snapshot to {cache_path}: {e}")
+    return df
+
+_snapshot = None
+# load_snapshot arguments from the command line
+snapshot_options = {}
+
+def get_snapshot():
+    """Snapshot shared by every analysis in this run, fetched on first use"""
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = load_snapshot(**snapshot_options)
+    return _snapshot
+
+# Statistics are computed in Postgres when these functions are installed ('server'),
+# on the local snapshot ('local'), or in Postgres with a local fallback ('auto')
+AGGREGATION_BACKEND = os.getenv("ANALYZER_AGGREGATION", "auto")
+
+AGGREGATION_SQL = """
+    CREATE OR REPLACE FUNCTION sephora_brand_counts(max_rows integer DEFAULT 20)
+    RETURNS TABLE (brand varchar, product_count bigint)
+    LANGUAGE sql STABLE AS $$
+        SELECT p.brand, count(*) AS product_count
+        FROM sephoraproducts p
+        WHERE p.brand IS NOT NULL AND p.brand <> ''
+        GROUP BY p.brand
+        ORDER BY product_count DESC, min(p.id)
+        LIMIT max_rows
+    $$;
+    
+    CREATE OR REPLACE FUNCTION sephora_type_counts(max_rows integer DEFAULT 20)
+    RETURNS TABLE (type varchar, product_count bigint)
+    LANGUAGE sql STABLE AS $$
+        SELECT p.type, count(*) AS product_count
+        FROM sephoraproducts p
+        WHERE p.type IS NOT NULL AND p.type <> ''
+        GROUP BY p.type
+        ORDER BY product_count DESC, min(p.id)
+        LIMIT max_rows
+    $$;
+    
+    CREATE OR REPLACE FUNCTION sephora_price_stats()
+    RETURNS TABLE (price_count bigint, min_price numeric, max_price numeric, avg_price numeric,
+                   median_price double precision)
+    LANGUAGE sql STABLE AS $$
+        SELECT count(*), min(p.price), max(p.price), avg(p.price),
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY p.price)
+        FROM sephoraproducts p
+        WHERE p.price IS NOT NULL AND p.price <> 0
+    $$;
+"""
+
+def aggregate(server_call, local_call):
+    """Run an analysis in Postgres if possible, otherwise over the local snapshot"""
+    global AGGREGATION_BACKEND
+    if AGGREGATION_BACKEND in ('auto', 'server'):
+        try:
+            return server_call()
+        except Exception as e:
+            if AGGREGATION_BACKEND == 'server':
+                raise
+            print(f"Server-side aggregation unavailable ({e}), computing locally. "
+                  f"Run the SQL from --print-aggregation-sql to enable it.")
+            AGGREGATION_BACKEND = 'local'
+    return local_call()
+
+def filled(df, column):
+    """Non-empty values of a column, like the truthiness checks on individual rows"""
+    if column not in df:
+        return pd.Series(dtype=object)
+    values = df[column].dropna()
+    return values[values.astype(bool)]
+
+def top_counts(values, limit):
+    """(value, count) pairs, most common first; ties keep first-seen order like Counter.most_common"""
+    counts = values.groupby(values, sort=False).size()
+    counts = counts.sort_values(ascending=False, kind='stable').head(limit)
+    return [(value, int(count)) for value, count in counts.items()]
+
 def get_product_count():
     """Get the total count of products in the database"""
     try:
-        response = supabase.table("sephoraproducts").select("*", count="exact").execute()
-        return response.count
+        return aggregate(
+            lambda: supabase.table("sephoraproducts").select("id", count="exact").limit(1).execute().count,
+            lambda: len(get_snapshot())
+        )
     except Exception as e:
         print(f"Error getting product count: {e}")
         return None
@@ -29,30 +200,46 @@ def get_product_count():
 def get_products_by_brand(limit=20):
     """Get counts of products by brand"""
     try:
-        response = supabase.table("sephoraproducts").select("brand").execute()
-        brands = [item['brand'] for item in response.data if item.get('brand')]
-        brand_counts = Counter(brands)
-        return brand_counts.most_common(limit)
+        return aggregate(
+            lambda: [(row['brand'], row['product_count'])
+                     for row in supabase.rpc("sephora_brand_counts", {"max_rows": limit}).execute().data],
+            lambda: top_counts(filled(get_snapshot(), 'brand'), limit)
+        )
     except Exception as e:
         print(f"Error getting brands: {e}")
         return []
 
+def server_price_distribution():
+    stats = supabase.rpc("sephora_price_stats", {}).execute().data[0]
+    if not stats['price_count']:
+        return None
+    return {
+        'min': float(stats['min_price']),
+        'max': float(stats['max_price']),
+        'avg': float(stats['avg_price']),
+        'median': float(stats['median_price']),
+        'count': stats['price_count']
+    }
+
+def local_price_distribution():
+    prices = filled(get_snapshot(), 'price')
+    
+    if prices.empty:
+        return None
+        
+    return {
+        'min': float(prices.min()),
+        'max': float(prices.max()),
+        'avg': float(prices.mean()),
+        # Interpolated like percentile_cont(0.5) on the server
+        'median': float(prices.median()),
+        'count': len(prices)
+    }
+
 def get_price_distribution():
     """Get price distribution information"""
     try:
-        response = supabase.table("sephoraproducts").select("price").execute()
-        prices = [item['price'] for item in response.data if item.get('price')]
-        
-        if not prices:
-            return None
-            
-        return {
-            'min': min(prices),
-            'max': max(prices),
-            'avg': sum(prices) / len(prices),
-            'median': sorted(prices)[len(prices) // 2],
-            'count': len(prices)
-        }
+        return aggregate(server_price_distribution, local_price_distribution)
     except Exception as e:
         print(f"Error getting price distribution: {e}")
         return None
@@ -60,77 +247,230 @@ def get_price_distribution():
 def get_product_types():
     """Get counts of different product types"""
     try:
-        response = supabase.table("sephoraproducts").select("type").execute()
-        types = [item['type'] for item in response.data if item.get('type')]
-        type_counts = Counter(types)
-        return type_counts.most_common(20)
+        return aggregate(
+            lambda: [(row['type'], row['product_count'])
+                     for row in supabase.rpc("sephora_type_counts", {"max_rows": 20}).execute().data],
+            lambda: top_counts(filled(get_snapshot(), 'type'), 20)
+        )
     except Exception as e:
         print(f"Error getting product types: {e}")
         return []
 
-def export_to_csv(filename="sephora_products.csv"):
-    """Export all products to a CSV file"""
+EXPORT_FORMATS = {
+    '.csv': 'csv',
+    '.csv.gz': 'csv.gz',
+    '.parquet': 'parquet',
+}
+
+def export_format(filename):
+    """Export format implied by a file name's extension"""
+    for extension, fmt in EXPORT_FORMATS.items():
+        if filename.endswith(extension):
+            return fmt
+    raise ValueError(f"Unsupported export file {filename}; use one of {', '.join(EXPORT_FORMATS)}")
+
+class CSVPageWriter:
+    """Appends pages to a CSV file, optionally gzipped, with one header"""
+    
+    def __init__(self, path, compressed=False):
+        self.file = gzip.open(path, 'wt', newline='', encoding='utf-8') if compressed \
+            else open(path, 'w', newline='', encoding='utf-8')
+        self.columns = None
+    
+    def write(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+            df.to_csv(self.file, index=False)
+        else:
+            df.reindex(columns=self.columns).to_csv(self.file, index=False, header=False)
+    
+    def close(self):
+        self.file.close()
+
+class ParquetPageWriter:
+    """Writes each page as a row group, keeping the schema of the first page"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.schema = None
+        self.writer = None
+    
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        if self.writer is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            # A column that is empty on the first page has no type yet; later pages hold text
+            for i, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(i, field.with_type(pa.string()))
+            self.schema = schema
+            self.writer = pq.ParquetWriter(self.path, schema)
+        table = pa.Table.from_pandas(df.reindex(columns=self.schema.names), schema=self.schema, preserve_index=False)
+        self.writer.write_table(table)
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def remove_partial(partial_path):
+    """Delete an unfinished export; the Parquet writer only creates it with the first page"""
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+
+def export_products(filename="sephora_products.csv", page_size=SNAPSHOT_PAGE_SIZE):
+    """
+    Stream every product to a CSV, gzipped CSV or Parquet file, one page at a
+    time, so memory stays flat however large the table is. The file is
+    written under a temporary name and only replaces `filename` when complete.
+    """
+    fmt = export_format(filename)
+    partial_path = f"{filename}.part"
+    writer = ParquetPageWriter(partial_path) if fmt == 'parquet' \
+        else CSVPageWriter(partial_path, compressed=(fmt == 'csv.gz'))
+    
+    exported = 0
     try:
-        response = supabase.table("sephoraproducts").select("*").execute()
-        if not response.data:
-            print("No data to export")
-            return False
-            
-        df = pd.DataFrame(response.data)
-        df.to_csv(filename, index=False)
-        print(f"Exported {len(df)} products to {filename}")
-        return True
+        for rows in iter_pages(page_size):
+            writer.write(coerce_numeric(pd.DataFrame(rows)))
+            exported += len(rows)
+    except BaseException:
+        writer.close()
+        remove_partial(partial_path)
+        raise
+    writer.close()
+    
+    if not exported:
+        remove_partial(partial_path)
+        print("No data to export")
+        return False
+    
+    os.replace(partial_path, filename)
+    print(f"Exported {exported} products to {filename}")
+    return True
+
+def export_to_csv(filename="sephora_products.csv", page_size=SNAPSHOT_PAGE_SIZE):
+    """Export all products to a file (CSV, .csv.gz or .parquet by extension)"""
+    try:
+        return export_products(filename, page_size)
     except Exception as e:
-        print(f"Error exporting to CSV: {e}")
+        print(f"Error exporting to {filename}: {e}")
         return False
 
-def visualize_data():
-    """Create basic visualizations of the data"""
+CHART_FORMATS = ('png', 'svg')
+
+def chart_slug(name):
+    """File-name-safe version of a brand or type"""
+    return re.sub(r'[^a-z0-9]+', '-', str(name).lower()).strip('-') or 'unnamed'
+
+def bar_chart(path, title, xlabel, items):
+    return {'kind': 'bar', 'path': path, 'title': title, 'xlabel': xlabel,
+            'labels': [str(name) for name, _ in items], 'values': [int(count) for _, count in items]}
+
+def price_histogram(path, title, prices):
+    return {'kind': 'hist', 'path': path, 'title': title, 'xlabel': 'Price ($)',
+            'values': [float(price) for price in prices]}
+
+def render_chart(chart):
+    """
+    Draw one chart description to its file. Runs in pool workers, so it only
+    gets plain lists, and closes the figure so a long run does not pile up
+    every chart it has drawn.
+    """
+    if chart['kind'] == 'bar':
+        fig, ax = plt.subplots(figsize=(12, 6))
+        ax.bar(chart['labels'], chart['values'])
+        ax.tick_params(axis='x', labelrotation=45)
+        plt.setp(ax.get_xticklabels(), ha='right')
+    else:
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.hist(chart['values'], bins=20)
     try:
-        # Get brand data
-        brands = get_products_by_brand(10)
-        if brands:
-            brand_names = [b[0] for b in brands]
-            brand_counts = [b[1] for b in brands]
-            
-            plt.figure(figsize=(12, 6))
-            plt.bar(brand_names, brand_counts)
-            plt.title('Top 10 Brands by Product Count')
-            plt.xlabel('Brand')
-            plt.ylabel('Number of Products')
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            plt.savefig('top_brands.png')
-            print("Created top_brands.png visualization")
+        ax.set_title(chart['title'])
+        ax.set_xlabel(chart['xlabel'])
+        ax.set_ylabel('Number of Products')
+        fig.tight_layout()
+        fig.savefig(chart['path'])
+    finally:
+        plt.close(fig)
+    return chart['path']
+
+def breakdown_charts(df, group_column, other_column, output_dir, fmt, limit=None):
+    """
+    A price histogram and a bar chart of the top values of `other_column` for
+    each of the most common values of `group_column`, e.g. one pair per brand
+    """
+    charts = []
+    directory = os.path.join(output_dir, group_column)
+    os.makedirs(directory, exist_ok=True)
+    
+    grouped = df.groupby(group_column, sort=False)
+    used_slugs = set()
+    for name, _ in top_counts(filled(df, group_column), limit):
+        rows = grouped.get_group(name)
+        # Distinct names can share a slug ("Dior" and "DIOR"); number the repeats
+        base = slug = chart_slug(name)
+        suffix = 2
+        while slug in used_slugs:
+            slug = f"{base}-{suffix}"
+            suffix += 1
+        used_slugs.add(slug)
         
-        # Get price data
-        response = supabase.table("sephoraproducts").select("price").execute()
-        prices = [item['price'] for item in response.data if item.get('price')]
+        prices = filled(rows, 'price')
+        if not prices.empty:
+            charts.append(price_histogram(os.path.join(directory, f"{slug}_prices.{fmt}"),
+                                          f"{name}: Distribution of Product Prices", prices))
+        others = top_counts(filled(rows, other_column), 10)
+        if others:
+            charts.append(bar_chart(os.path.join(directory, f"{slug}_{other_column}s.{fmt}"),
+                                    f"{name}: Top {other_column.title()}s by Product Count",
+                                    other_column.title(), others))
+    return charts
+
+def dashboard_charts(output_dir=".", fmt="png", breakdown=(), breakdown_limit=None):
+    """Every chart for a run, computed from the shared snapshot"""
+    charts = []
+    os.makedirs(output_dir, exist_ok=True)
+    
+    brands = get_products_by_brand(10)
+    if brands:
+        charts.append(bar_chart(os.path.join(output_dir, f"top_brands.{fmt}"),
+                                'Top 10 Brands by Product Count', 'Brand', brands))
+    
+    prices = filled(get_snapshot(), 'price')
+    if not prices.empty:
+        charts.append(price_histogram(os.path.join(output_dir, f"price_distribution.{fmt}"),
+                                      'Distribution of Product Prices', prices))
+    
+    types = get_product_types()
+    if types and len(types) > 5:
+        charts.append(bar_chart(os.path.join(output_dir, f"product_types.{fmt}"),
+                                'Top Product Types', 'Product Type', types[:10]))
+    
+    if 'brand' in breakdown:
+        charts.extend(breakdown_charts(get_snapshot(), 'brand', 'type', output_dir, fmt, breakdown_limit))
+    if 'type' in breakdown:
+        charts.extend(breakdown_charts(get_snapshot(), 'type', 'brand', output_dir, fmt, breakdown_limit))
+    return charts
+
+def visualize_data(output_dir=".", fmt="png", workers=0, breakdown=(), breakdown_limit=None):
+    """
+    Create visualizations of the data. With workers, charts are drawn in
+    that many processes; the data for each is prepared here first, so
+    workers never query the database.
+    """
+    try:
+        charts = dashboard_charts(output_dir, fmt, breakdown, breakdown_limit)
         
-        if prices:
-            plt.figure(figsize=(10, 6))
-            plt.hist(prices, bins=20)
-            plt.title('Distribution of Product Prices')
-            plt.xlabel('Price ($)')
-            plt.ylabel('Number of Products')
-            plt.savefig('price_distribution.png')
-            print("Created price_distribution.png visualization")
-            
-        # Get product type data
-        types = get_product_types()
-        if types and len(types) > 5:
-            type_names = [t[0] for t in types[:10]]
-            type_counts = [t[1] for t in types[:10]]
-            
-            plt.figure(figsize=(12, 6))
-            plt.bar(type_names, type_counts)
-            plt.title('Top Product Types')
-            plt.xlabel('Product Type')
-            plt.ylabel('Number of Products')
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            plt.savefig('product_types.png')
-            print("Created product_types.png visualization")
+        if workers > 0 and len(charts) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(render_chart, chart) for chart in charts]
+                for future in as_completed(futures):
+                    print(f"Created {future.result()} visualization")
+        else:
+            for chart in charts:
+                print(f"Created {render_chart(chart)} visualization")
             
         return True
     except Exception as e:
@@ -138,22 +478,53 @@ def visualize_data():
         return False
 
 def main():
+    global AGGREGATION_BACKEND
     parser = argparse.ArgumentParser(description='Analyze Sephora product data')
     parser.add_argument('--count', action='store_true', help='Get total product count')
     parser.add_argument('--brands', action='store_true', help='Get top brands')
     parser.add_argument('--prices', action='store_true', help='Get price distribution')
     parser.add_argument('--types', action='store_true', help='Get product types')
     parser.add_argument('--export', action='store_true', help='Export data to CSV')
+    parser.add_argument('--export-file', default='sephora_products.csv',
+                        help='Export destination; .csv, .csv.gz or .parquet selects the format')
+    parser.add_argument('--page-size', type=int, default=SNAPSHOT_PAGE_SIZE,
+                        help='Rows per request when paging through the table')
     parser.add_argument('--visualize', action='store_true', help='Create visualizations')
+    parser.add_argument('--chart-dir', default='.', help='Directory to write charts to')
+    parser.add_argument('--chart-format', choices=CHART_FORMATS, default='png', help='Chart file format')
+    parser.add_argument('--chart-workers', type=int, default=0,
+                        help='Processes to render charts in (0 renders them in this process)')
+    parser.add_argument('--chart-breakdown', choices=['brand', 'type'], action='append', default=[],
+                        help='Also chart each brand or type; may be given twice')
+    parser.add_argument('--chart-limit', type=int,
+                        help='Only break down the most common brands or types (default: all)')
     parser.add_argument('--all', action='store_true', help='Run all analyses')
+    parser.add_argument('--cache', help='Parquet file to cache the table snapshot in between runs')
+    parser.add_argument('--max-age', type=float, default=SNAPSHOT_MAX_AGE_MINUTES,
+                        help='Minutes a cached snapshot stays fresh')
+    parser.add_argument('--refresh', action='store_true', help='Refetch the snapshot even if the cache is fresh')
+    parser.add_argument('--aggregate', choices=['auto', 'server', 'local'], default=AGGREGATION_BACKEND,
+                        help='Compute statistics in Postgres, locally, or in Postgres when available (default)')
+    parser.add_argument('--print-aggregation-sql', action='store_true',
+                        help='Print the SQL that installs the server-side aggregation functions')
     
     args = parser.parse_args()
     
-    # If no arguments provided, show help
-    if not any(vars(args).values()):
+    if args.print_aggregation_sql:
+        print("Run the following SQL in the Supabase SQL Editor:")
+        print(AGGREGATION_SQL)
+        return
+    
+    # If no analysis was requested, show help
+    if not any((args.count, args.brands, args.prices, args.types, args.export, args.visualize, args.all)):
         parser.print_help()
         return
     
+    # Analyses that need rows share one snapshot of the table
+    AGGREGATION_BACKEND = args.aggregate
+    snapshot_options.update(cache_path=args.cache, max_age_minutes=args.max_age, refresh=args.refresh,
+                            page_size=args.page_size)
+    
     # Run selected analyses
     if args.count or args.all:
         count = get_product_count()
@@ -180,10 +551,11 @@ def main():
             print(f"  {type_name}: {count} products")
     
     if args.export or args.all:
-        export_to_csv()
+        export_to_csv(args.export_file, args.page_size)
         
     if args.visualize or args.all:
-        visualize_data()
+        visualize_data(args.chart_dir, args.chart_format, args.chart_workers,
+                       args.chart_breakdown, args.chart_limit)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,16 @@
 from firecrawl import FirecrawlApp
 import os
+import re
+import time
+import random
+import argparse
+from urllib.parse import urljoin, urlparse
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
 import json
 
 load_dotenv()
-app = FirecrawlApp(api_key=os.getenv("FIRECRAWL_API_KEY"))
 
 json_schema = {
     "type": "object",
@@ -29,55 +34,234 @@ json_schema = {
                     "skin_type": {"type": "string"},
                     "allergies/restrictions": {"type": "string"}
                 },
-                "required": ["name", "brand", "price", "product_link", ""]
+                "required": ["product_name", "brand", "price", "product_link"]
             }
         }
     },
     "required": ["products"]
 }
 
-# Perform the crawl
-crawl_status = app.crawl_url(
-    'https://www.sephora.com/shop/blush',
-    params={
-        'limit': 5,
-        'scrapeOptions': {
-            'formats': ['json'],
-            'jsonOptions': {
-                'schema': json_schema
+# Products per upsert request
+UPSERT_CHUNK_SIZE = 500
+# Attempts after the first when the database is unreachable or busy, backing off 1s, 2s, 4s
+UPSERT_RETRIES = 3
+# PostgREST connection errors and Postgres serialization failures/deadlocks; HTTP 5xx
+# statuses and SQLSTATE classes 5x (resources, shutdown, system errors) are matched by prefix
+TRANSIENT_ERROR_CODES = {'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003', '40001', '40P01'}
+
+# Extracted field -> product table column
+PRODUCT_COLUMNS = {
+    'brand': 'brand',
+    'product_link': 'link',
+    'product_name': 'name',
+    'product_type': 'type',
+    'product_image': 'image',
+    'price': 'price',
+    'rating': 'rating',
+    'color': 'color',
+    'skin_tone': 'skin_tone',
+    'under_tone': 'under_tone',
+    'coverage_level': 'coverage_level',
+    'skin_type': 'skin_type',
+    'allergies/restrictions': 'restrictions',
+}
+
+JSON_TYPES = {'string': str, 'number': (int, float)}
+
+def crawl(url, limit):
+    """Crawl a category with Firecrawl, extracting products with json_schema"""
+    app = FirecrawlApp(api_key=os.getenv("FIRECRAWL_API_KEY"))
+    return app.crawl_url(
+        url,
+        params={
+            'limit': limit,
+            'scrapeOptions': {
+                'formats': ['json'],
+                'jsonOptions': {
+                    'schema': json_schema
+                }
             }
-        }
-    },
-    poll_interval=30
-)
+        },
+        poll_interval=30
+    )
+
+def extracted_products(crawl_status):
+    """Products extracted from every crawled page"""
+    products = []
+    for page in crawl_status.get('data') or []:
+        page_json = page.get('json') or {}
+        products.extend(page_json.get('products') or [])
+    return products
 
-# # Access the JSON output
-results = crawl_status['data'][0]['json']['products']
+def parse_number(value):
+    """Numbers the extraction returned as text, such as $32.00 or 4.5 stars"""
+    if isinstance(value, str):
+        match = re.search(r'\d[\d,]*(?:\.\d+)?', value)
+        if match:
+            return float(match.group().replace(',', ''))
+    return value
 
-# print(crawl_status)
+def normalize_product(product, base_url):
+    """Trimmed strings with blanks as missing, numeric prices and ratings, absolute URLs"""
+    normalized = {}
+    for field, value in product.items():
+        if isinstance(value, str):
+            value = value.strip() or None
+        if value is None:
+            continue
+        if field in ('price', 'rating'):
+            value = parse_number(value)
+        elif field in ('product_link', 'product_image') and isinstance(value, str):
+            value = urljoin(base_url, value)
+        normalized[field] = value
+    return normalized
 
-if results:
+def is_uri(value):
+    """An absolute http(s) URL, which is what format: uri means for product links and images"""
+    parsed = urlparse(value)
+    return parsed.scheme in ('http', 'https') and bool(parsed.netloc) and not any(c.isspace() for c in value)
+
+def schema_errors(product, schema):
+    """Ways a product breaks the item schema; empty when it is valid"""
+    errors = [f"missing {field}" for field in schema.get('required', []) if field not in product]
+    for field, value in product.items():
+        field_schema = schema['properties'].get(field, {})
+        expected = field_schema.get('type')
+        # bool is an int subclass but never a valid price or rating
+        if expected in JSON_TYPES and (not isinstance(value, JSON_TYPES[expected]) or isinstance(value, bool)):
+            errors.append(f"{field} is not a {expected}")
+        elif field_schema.get('format') == 'uri' and not is_uri(value):
+            errors.append(f"{field} is not a URL")
+    return errors
+
+def prepare_rows(products, base_url):
+    """
+    Validate and normalize a crawl's products into product table rows, one
+    per link. Rows only hold the fields that were extracted, so an upsert
+    never overwrites stored values with nulls. A link seen on several pages
+    keeps its first values and takes any fields it was missing from the
+    later ones.
+    Returns (rows, rejected) where rejected pairs each bad product with its errors.
+    """
+    item_schema = json_schema['properties']['products']['items']
+    rows = {}
+    rejected = []
+    for product in products:
+        if not isinstance(product, dict):
+            rejected.append((product, ["not an object"]))
+            continue
+        product = normalize_product(product, base_url)
+        errors = schema_errors(product, item_schema)
+        if errors:
+            rejected.append((product, errors))
+            continue
+        
+        row = {column: product[field] for field, column in PRODUCT_COLUMNS.items() if field in product}
+        existing = rows.setdefault(row['link'], row)
+        if existing is not row:
+            for column, value in row.items():
+                existing.setdefault(column, value)
+    return list(rows.values()), rejected
+
+def is_transient(error):
+    """Whether a failed upsert may succeed unchanged, as opposed to a row being rejected"""
+    if not isinstance(error, APIError):
+        # Connection errors and timeouts
+        return True
+    code = str(error.code)
+    return code in TRANSIENT_ERROR_CODES or code.startswith('5')
+
+def upsert_chunk(supabase, rows):
+    """
+    Upsert rows by link in one request. Transient failures are retried with
+    backoff. If the database rejects the data, split the rows in half and
+    retry each half, so a bad product costs a few requests rather than one
+    per row. Returns (successful, failed) row counts.
+    """
+    for attempt in range(UPSERT_RETRIES + 1):
+        try:
+            supabase.table("product").upsert(rows, on_conflict="link").execute()
+            return len(rows), 0
+        except Exception as e:
+            error = e
+            if not is_transient(e):
+                break
+            if attempt < UPSERT_RETRIES:
+                delay = 2 ** attempt + random.uniform(0, 1)
+                print(f"Upsert of {len(rows)} products failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+    else:
+        # Still failing for reasons unrelated to the rows; splitting would not help
+        print(f"Failed to store {len(rows)} products after {UPSERT_RETRIES} retries: {error}")
+        return 0, len(rows)
+    
+    if len(rows) == 1:
+        print(f"Failed to store {rows[0]['link']}: {error}")
+        return 0, 1
+    middle = len(rows) // 2
+    first_ok, first_failed = upsert_chunk(supabase, rows[:middle])
+    second_ok, second_failed = upsert_chunk(supabase, rows[middle:])
+    return first_ok + second_ok, first_failed + second_failed
+
+def upsert_rows(supabase, rows, chunk_size=UPSERT_CHUNK_SIZE):
+    """
+    Upsert rows by link in chunks. A bulk upsert sets every column named by
+    any row in the request, using null where a row lacks one, so rows are
+    grouped by the columns they carry and each chunk only names those.
+    Returns (successful, failed) row counts.
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(frozenset(row), []).append(row)
+    
+    successful = failed = 0
+    for group in groups.values():
+        for i in range(0, len(group), chunk_size):
+            chunk_ok, chunk_failed = upsert_chunk(supabase, group[i:i + chunk_size])
+            successful += chunk_ok
+            failed += chunk_failed
+    return successful, failed
+
+def ingest(crawl_status, base_url, chunk_size=UPSERT_CHUNK_SIZE):
+    """Store a Firecrawl crawl's products in the product table"""
+    products = extracted_products(crawl_status)
+    if not products:
+        print("No data available in the crawl status")
+        return 0, 0
+    
+    rows, rejected = prepare_rows(products, base_url)
+    for product, errors in rejected:
+        print(f"Skipping invalid product {product.get('product_link') if isinstance(product, dict) else product!r}: "
+              f"{', '.join(errors)}")
+    print(f"{len(products)} products extracted from {len(crawl_status['data'])} pages: "
+          f"{len(rows)} unique, {len(rejected)} invalid")
+    if not rows:
+        return 0, 0
+    
     supabase: Client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+    successful, failed = upsert_rows(supabase, rows, chunk_size)
+    print(f"Stored {successful} products, {failed} failed")
+    return successful, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Crawl a Sephora category with Firecrawl and store its products')
+    parser.add_argument('--url', default='https://www.sephora.com/shop/blush', help='Category to crawl')
+    parser.add_argument('--limit', type=int, default=5, help='Maximum pages to crawl')
+    parser.add_argument('--chunk-size', type=int, default=UPSERT_CHUNK_SIZE, help='Products per upsert request')
+    parser.add_argument('--input', help='Ingest a crawl result saved with --save instead of crawling')
+    parser.add_argument('--save', help='Save the crawl result to this JSON file')
+    args = parser.parse_args()
+    
+    if args.input:
+        with open(args.input) as f:
+            crawl_status = json.load(f)
+    else:
+        crawl_status = crawl(args.url, args.limit)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(crawl_status, f)
+    
+    ingest(crawl_status, args.url, args.chunk_size)
 
-    for product in results:
-        brand = product['brand']
-        product_link = product['product_link']
-        product_name = product['product_name']
-        product_type = product['product_type']
-        product_image = product['product_image']
-        price = product['price']
-        rating = product['rating']
-        color = product['color']
-        skin_tone = product['skin_tone']
-        under_tone = product['under_tone']
-        coverage_level = product['coverage_level']
-        skin_type = product['skin_type']
-        restrictions = product['allergies/restrictions']
-
-        response = (
-            supabase.table("product")
-            .insert({'brand': brand, 'link': product_link, 'name': product_name, 'type': product_type, 'image': product_image, 'price': price, 'rating': rating, 'color': color, 'skin_tone': skin_tone, 'under_tone': under_tone, 'coverage_level': coverage_level, 'skin_type': skin_tone, 'restrictions': restrictions})
-            .execute()
-        )
-else:
-    print("No data available in the crawl status")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
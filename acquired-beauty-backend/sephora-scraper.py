@@ -5,10 +5,23 @@ import json
 import random
 import requests
 from bs4 import BeautifulSoup
+from functools import lru_cache
 from tqdm import tqdm
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
 import logging
+import argparse
+import threading
+import queue
+import sqlite3
+import gzip
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+import urllib3
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
@@ -17,6 +30,32 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 # Initialize Supabase client
@@ -60,6 +99,25 @@ def ensure_table_exists():
         else:
             raise e
 
+# Makeup category listing pages crawled by --all-categories
+MAKEUP_CATEGORIES = [
+    "https://www.sephora.com/shop/blush",
+    "https://www.sephora.com/shop/bronzer",
+    "https://www.sephora.com/shop/luminizer-luminous-makeup",
+    "https://www.sephora.com/shop/foundation-makeup",
+    "https://www.sephora.com/shop/concealer",
+    "https://www.sephora.com/shop/face-primer",
+    "https://www.sephora.com/shop/setting-powder-face-powder",
+    "https://www.sephora.com/shop/eyeshadow",
+    "https://www.sephora.com/shop/mascara",
+    "https://www.sephora.com/shop/eyeliner",
+    "https://www.sephora.com/shop/eyebrow-makeup-pencils",
+    "https://www.sephora.com/shop/lipstick",
+    "https://www.sephora.com/shop/lip-gloss",
+    "https://www.sephora.com/shop/lip-stain",
+    "https://www.sephora.com/shop/lip-liner",
+]
+
 def get_headers():
     """Create realistic browser headers to avoid being blocked"""
     user_agents = [
@@ -81,38 +139,257 @@ def get_headers():
         'DNT': '1'
     }
 
-def create_session_with_retries():
-    """Creates a session with retry logic"""
+# Connection pool size for each worker's session, and whether to keep connections alive
+SESSION_POOL_SIZE = int(os.getenv("SCRAPER_POOL_SIZE", "10"))
+SESSION_KEEP_ALIVE = os.getenv("SCRAPER_KEEP_ALIVE", "1") != "0"
+
+class FetchStats:
+    """
+    Thread-safe counters for the fetch layer: how often connections are
+    reused versus opened (each new HTTPS connection is a TLS handshake) and
+    where the time goes in each request.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.new_connections = 0
+            self.tls_handshakes = 0
+            self.bytes_received = 0
+            self.phase_seconds = {'rate_limit_wait': 0.0, 'connect': 0.0, 'headers': 0.0, 'body': 0.0}
+    
+    def record_connect(self, seconds, tls):
+        with self.lock:
+            self.new_connections += 1
+            if tls:
+                self.tls_handshakes += 1
+            self.phase_seconds['connect'] += seconds
+    
+    def record_request(self, wait_seconds, headers_seconds, body_seconds, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes_received += size
+            self.phase_seconds['rate_limit_wait'] += wait_seconds
+            self.phase_seconds['headers'] += headers_seconds
+            self.phase_seconds['body'] += body_seconds
+    
+    def summary(self):
+        with self.lock:
+            requests_made = max(self.requests, 1)
+            reused = max(self.requests - self.new_connections, 0)
+            # Time to headers includes opening the connection, so split it out
+            ttfb = max(self.phase_seconds['headers'] - self.phase_seconds['connect'], 0.0)
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': reused,
+                'connection_reuse_rate': reused / requests_made,
+                'tls_handshakes': self.tls_handshakes,
+                'bytes_received': self.bytes_received,
+                'avg_ms': {
+                    'rate_limit_wait': 1000 * self.phase_seconds['rate_limit_wait'] / requests_made,
+                    'connect_tls': 1000 * self.phase_seconds['connect'] / requests_made,
+                    'time_to_first_byte': 1000 * ttfb / requests_made,
+                    'body_download': 1000 * self.phase_seconds['body'] / requests_made,
+                }
+            }
+    
+    def log_summary(self):
+        summary = self.summary()
+        logger.info(
+            f"Fetch stats: {summary['requests']} requests, {summary['new_connections']} new connections "
+            f"({summary['tls_handshakes']} TLS handshakes), {summary['reused_connections']} reused "
+            f"({summary['connection_reuse_rate']:.0%}), {summary['bytes_received'] / 1e6:.1f} MB received"
+        )
+        phases = ", ".join(f"{name} {ms:.1f}ms" for name, ms in summary['avg_ms'].items())
+        logger.info(f"Average time per request: {phases}")
+
+fetch_stats = FetchStats()
+
+class InstrumentedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        fetch_stats.record_connect(time.perf_counter() - start, tls=False)
+
+class InstrumentedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        # For HTTPS this covers the TCP connect and the TLS handshake
+        start = time.perf_counter()
+        super().connect()
+        fetch_stats.record_connect(time.perf_counter() - start, tls=True)
+
+class InstrumentedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = InstrumentedHTTPConnection
+
+class InstrumentedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = InstrumentedHTTPSConnection
+
+class InstrumentedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections report to fetch_stats when they are opened"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': InstrumentedHTTPConnectionPool,
+            'https': InstrumentedHTTPSConnectionPool,
+        }
+
+def create_session_with_retries(pool_size=None):
+    """Creates a pooled, instrumented session with retry logic"""
+    pool_size = pool_size or SESSION_POOL_SIZE
     session = requests.Session()
+    # 429s are left to get_page_with_retry so they can be backed off properly
     retries = Retry(
         total=5,
         backoff_factor=0.5,
-        status_forcelist=[429, 500, 502, 503, 504],
+        status_forcelist=[500, 502, 503, 504],
         allowed_methods=["GET"]
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    adapter = InstrumentedHTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
 
-def get_page_with_retry(url, max_retries=3):
-    """Fetch a page with retry logic and proper delays"""
-    session = create_session_with_retries()
+worker_state = threading.local()
+
+def get_worker_session():
+    """
+    Return this thread's long-lived session, creating it on first use.
+    Reusing it keeps TCP/TLS connections and the cookie jar across pages.
+    """
+    session = getattr(worker_state, 'session', None)
+    if session is None:
+        session = create_session_with_retries()
+        worker_state.session = session
+    return session
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a request may be sent"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+    
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+    
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+
+class HostRateLimiter:
+    """
+    Per-host politeness for concurrent crawls. Each host gets a token bucket
+    whose rate is halved (and paused) on a 429 and creeps back up to the
+    configured rate as requests succeed again.
+    """
+    
+    def __init__(self, rate=0.25, burst=2, min_rate=0.02, jitter=1.0):
+        self.max_rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.jitter = jitter
+        self.buckets = {}
+        self.lock = threading.Lock()
+    
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.max_rate, self.burst)
+            return self.buckets[host]
+    
+    def acquire(self, url):
+        self.bucket(url).acquire()
+        # Add jitter to appear more human-like
+        if self.jitter:
+            time.sleep(random.uniform(0, self.jitter))
+    
+    def record_success(self, url):
+        bucket = self.bucket(url)
+        if bucket.rate < self.max_rate:
+            bucket.set_rate(min(self.max_rate, bucket.rate + self.max_rate * 0.1))
+    
+    def record_throttle(self, url, retry_after=None):
+        bucket = self.bucket(url)
+        bucket.set_rate(max(self.min_rate, bucket.rate / 2))
+        wait_time = retry_after if retry_after is not None else 30 + random.uniform(5, 15)
+        logger.warning(f"Rate limited by {urlparse(url).netloc}. Slowing to {bucket.rate:.3f} req/s "
+                       f"and pausing {wait_time:.2f} seconds...")
+        bucket.pause(wait_time)
+
+def parse_retry_after(response):
+    """Read a Retry-After header given in seconds, if any"""
+    value = response.headers.get('Retry-After', '')
+    return float(value) if value.isdigit() else None
+
+def get_page_with_retry(url, max_retries=3, rate_limiter=None, extra_headers=None):
+    """
+    Fetch a page with retry logic and proper delays.
+    extra_headers may carry conditional request headers, in which case a
+    304 Not Modified response is returned as well.
+    """
+    session = get_worker_session()
     retries = 0
     while retries < max_retries:
         try:
-            # Add jitter to delay to appear more human-like
-            time.sleep(random.uniform(3, 7))
-            response = session.get(url, headers=get_headers(), timeout=30)
+            wait_start = time.perf_counter()
+            if rate_limiter:
+                rate_limiter.acquire(url)
+            else:
+                # Add jitter to delay to appear more human-like
+                time.sleep(random.uniform(3, 7))
+            
+            headers = get_headers()
+            if extra_headers:
+                headers.update(extra_headers)
+            if not SESSION_KEEP_ALIVE:
+                headers['Connection'] = 'close'
+            
+            request_start = time.perf_counter()
+            response = session.get(url, headers=headers, timeout=30, stream=True)
+            headers_done = time.perf_counter()
+            content = response.content
+            body_done = time.perf_counter()
+            fetch_stats.record_request(request_start - wait_start, headers_done - request_start,
+                                       body_done - headers_done, len(content))
             
-            if response.status_code == 200:
+            if response.status_code == 200 or (response.status_code == 304 and extra_headers):
+                if rate_limiter:
+                    rate_limiter.record_success(url)
                 return response
             
             # If we get a 429 (Too Many Requests), add longer delay
             if response.status_code == 429:
-                wait_time = 30 + random.uniform(5, 15)
-                logger.warning(f"Rate limited. Waiting {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
+                if rate_limiter:
+                    rate_limiter.record_throttle(url, parse_retry_after(response))
+                else:
+                    wait_time = 30 + random.uniform(5, 15)
+                    logger.warning(f"Rate limited. Waiting {wait_time:.2f} seconds...")
+                    time.sleep(wait_time)
             else:
                 logger.warning(f"Got status code {response.status_code} for {url}")
             
@@ -124,57 +401,209 @@ def get_page_with_retry(url, max_retries=3):
     
     return None
 
-def save_debug_html(html_content, page_num):
-    """Save HTML content to a file for debugging"""
-    debug_dir = "debug_output"
-    os.makedirs(debug_dir, exist_ok=True)
-    
-    filename = f"{debug_dir}/sephora_page_{page_num}.html"
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(html_content)
-    logger.info(f"Saved HTML content to {filename} for debugging")
-    return filename
-
-def save_debug_json(json_data, name):
-    """Save JSON content to a file for debugging"""
-    debug_dir = "debug_output"
-    os.makedirs(debug_dir, exist_ok=True)
-    
-    filename = f"{debug_dir}/{name}.json"
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(json_data, f, indent=2)
-    logger.info(f"Saved JSON content to {filename} for debugging")
-    return filename
-
-def save_element_debug(element, index):
-    """Save individual element HTML for debugging"""
-    debug_dir = "debug_output"
-    os.makedirs(debug_dir, exist_ok=True)
-    
-    filename = f"{debug_dir}/product_element_{index}.html"
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(str(element))
-    logger.info(f"Saved element HTML to {filename} for debugging")
-    return filename
+# Debug capture is off unless a sample rate is set; 1.0 captures every page
+DEBUG_SAMPLE_RATE = float(os.getenv("SCRAPER_DEBUG_SAMPLE", "0"))
+DEBUG_OUTPUT_DIR = os.getenv("SCRAPER_DEBUG_DIR", "debug_output")
+
+def category_slug(category_url):
+    return urlparse(category_url).path.rstrip('/').split('/')[-1] or 'unknown'
+
+class DebugCapture:
+    """
+    Opt-in capture of fetched pages, product elements and embedded JSON.
+    A sample of pages is chosen per page; everything extracted while that page
+    is processed is queued and written by a background thread as gzip files
+    named by content hash under <root>/<run>/<category>/, with a manifest.jsonl
+    mapping page and element names to files. When a page is not sampled the
+    capture calls return immediately and nothing touches the disk.
+    """
+    
+    def __init__(self, root=DEBUG_OUTPUT_DIR, sample_rate=DEBUG_SAMPLE_RATE, queue_size=256):
+        self.root = root
+        self.sample_rate = sample_rate
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.directories = set()
+        self.written = 0
+        self.duplicates = 0
+        self.dropped = 0
+    
+    def configure(self, sample_rate=None, root=None, run_id=None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if root is not None:
+            self.root = root
+        if run_id is not None:
+            self.run_id = run_id
+    
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+    
+    @property
+    def active(self):
+        """Whether the page being processed on this thread is captured"""
+        return getattr(self.local, 'directory', None) is not None
+    
+    @contextmanager
+    def page(self, category_url, page, html_content):
+        """Capture the page, and everything saved while it is processed, if it is sampled"""
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            yield
+            return
+        
+        self.local.directory = os.path.join(self.root, self.run_id, category_slug(category_url))
+        self.local.page = page
+        try:
+            self.save('page', html_content, 'html')
+            yield
+        finally:
+            self.local.directory = None
+    
+    def save(self, kind, content, ext='json'):
+        """Queue text or a JSON-serializable object for the background writer"""
+        directory = getattr(self.local, 'directory', None)
+        if directory is None:
+            return
+        
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='debug-capture', daemon=True)
+                    self.thread.start()
+        
+        try:
+            self.queue.put_nowait((directory, self.local.page, kind, content, ext))
+        except queue.Full:
+            # Never stall the crawl on debug output
+            self.dropped += 1
+    
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as e:
+                logger.error(f"Error writing debug capture: {e}")
+            finally:
+                self.queue.task_done()
+    
+    def write(self, directory, page, kind, content, ext):
+        if isinstance(content, str):
+            data = content.encode('utf-8')
+        else:
+            data = json.dumps(content, default=str).encode('utf-8')
+        
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        
+        filename = f"{kind}-{hashlib.sha1(data).hexdigest()[:16]}.{ext}.gz"
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            self.duplicates += 1
+        else:
+            with gzip.open(path, 'wb', compresslevel=6) as f:
+                f.write(data)
+            self.written += 1
+        
+        with open(os.path.join(directory, 'manifest.jsonl'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'page': page, 'kind': kind, 'file': filename}) + '\n')
+    
+    def flush(self):
+        """Wait until everything queued so far is written"""
+        if self.thread is not None:
+            self.queue.join()
+    
+    def close(self):
+        """Flush queued captures and stop the writer"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        logger.info(f"Debug capture: {self.written} files written to {os.path.join(self.root, self.run_id)}, "
+                    f"{self.duplicates} duplicates skipped, {self.dropped} dropped")
+
+debug_capture = DebugCapture()
+
+def find_state_blob(html_content, name):
+    """
+    Locate the JSON object assigned to window.<name> with a single scan of the page.
+    Returns the object text, or None when the page does not embed it.
+    """
+    marker = f"window.{name}"
+    index = html_content.find(marker)
+    if index == -1:
+        return None
+    
+    start = html_content.find('{', index + len(marker))
+    if start == -1 or html_content[index + len(marker):start].strip() != '=':
+        return None
+    
+    end = html_content.find('</script>', start)
+    if end == -1:
+        end = len(html_content)
+    return html_content[start:end].rstrip().rstrip(';')
+
+# With ijson's C backend each subtree is streamed out of the blob without
+# building the rest of the state; otherwise the whole blob is parsed once
+STREAM_STATE = ijson is not None and ijson.backend == 'yajl2_c'
+
+class StateBlob:
+    """JSON state embedded in a page, read one subtree at a time"""
+    
+    def __init__(self, text):
+        self.text = text
+        self.data = text.encode('utf-8') if STREAM_STATE else None
+        self.state = None
+    
+    def node(self, path):
+        if self.state is None:
+            self.state = orjson.loads(self.text) if orjson is not None else json.loads(self.text)
+        node = self.state
+        for part in path.split('.') if path else []:
+            node = node.get(part) if isinstance(node, dict) else None
+        return node
+    
+    def object_items(self, path):
+        """(key, value) pairs of the object at a dotted path ('' is the top level)"""
+        if STREAM_STATE:
+            return list(ijson.kvitems(self.data, path, use_float=True))
+        node = self.node(path)
+        return list(node.items()) if isinstance(node, dict) else []
+    
+    def array_items(self, path):
+        """Items of the array at a dotted path"""
+        if STREAM_STATE:
+            return list(ijson.items(self.data, f"{path}.item" if path else 'item', use_float=True))
+        node = self.node(path)
+        return node if isinstance(node, list) else []
 
 def extract_api_data(html_content):
     """Try to extract product data from any embedded API responses in the page"""
     products = []
     
-    # Look for JSONP data in script tags
-    match = re.search(r'window\.__PRELOADED_STATE__ = (.+?);\s*</script>', html_content)
-    if match:
+    # Only the product entities and search results are built from the state blob
+    state_blob = find_state_blob(html_content, '__PRELOADED_STATE__')
+    if state_blob:
         try:
-            state_data = json.loads(match.group(1))
+            state = StateBlob(state_blob)
             logger.info("Found PRELOADED_STATE data")
-            save_debug_json(state_data, "preloaded_state")
             
             # Try to locate product data in the state object
-            if 'entities' in state_data and 'products' in state_data['entities']:
-                product_dict = state_data['entities']['products']
-                logger.info(f"Found {len(product_dict)} products in PRELOADED_STATE")
+            product_entries = state.object_items('entities.products')
+            if product_entries:
+                logger.info(f"Found {len(product_entries)} products in PRELOADED_STATE")
+                if debug_capture.active:
+                    debug_capture.save('preloaded-state', dict(product_entries))
                 
-                for product_id, product_data in product_dict.items():
+                for product_id, product_data in product_entries:
                     try:
                         if 'currentSku' in product_data and 'brandName' in product_data:
                             product = {
@@ -190,55 +619,51 @@ def extract_api_data(html_content):
                         logger.error(f"Error processing API product: {e}")
             
             # Check for products in page content/results
-            if 'pageContent' in state_data:
-                page_content = state_data['pageContent']
-                if isinstance(page_content, dict) and 'results' in page_content:
-                    for result in page_content['results']:
-                        try:
-                            if 'productId' in result and 'displayName' in result:
-                                product = {
-                                    'url': f"/product/{result.get('productId', '')}",
-                                    'brand': result.get('brandName', ''),
-                                    'name': result.get('displayName', ''),
-                                    'price': str(result.get('currentSku', {}).get('valuePrice', 0) or 
-                                                result.get('valuePrice', 0)),
-                                    'rating': str(result.get('rating', 0)),
-                                    'image': result.get('heroImage', '')
-                                }
-                                products.append(product)
-                        except Exception as e:
-                            logger.error(f"Error processing product from results: {e}")
+            for result in state.array_items('pageContent.results'):
+                try:
+                    if 'productId' in result and 'displayName' in result:
+                        product = {
+                            'url': f"/product/{result.get('productId', '')}",
+                            'brand': result.get('brandName', ''),
+                            'name': result.get('displayName', ''),
+                            'price': str(result.get('currentSku', {}).get('valuePrice', 0) or 
+                                        result.get('valuePrice', 0)),
+                            'rating': str(result.get('rating', 0)),
+                            'image': result.get('heroImage', '')
+                        }
+                        products.append(product)
+                except Exception as e:
+                    logger.error(f"Error processing product from results: {e}")
         except Exception as e:
             logger.error(f"Error extracting API data: {e}")
     
     # Also look for GraphQL data or other API responses
-    graphql_match = re.search(r'window\.__APOLLO_STATE__ = (.+?);\s*</script>', html_content)
-    if graphql_match:
+    apollo_blob = find_state_blob(html_content, '__APOLLO_STATE__')
+    if apollo_blob:
         try:
-            apollo_data = json.loads(graphql_match.group(1))
             logger.info("Found APOLLO_STATE data")
-            save_debug_json(apollo_data, "apollo_state")
             
-            # Try to process Apollo state data
-            # Look for products in the Apollo cache
-            for key, value in apollo_data.items():
-                if isinstance(value, dict):
-                    # Check if this looks like a product
-                    if 'brandName' in value and 'displayName' in value:
-                        try:
-                            product_id = value.get('productId', '')
-                            if product_id:
-                                product = {
-                                    'url': f"/product/{product_id}",
-                                    'brand': value.get('brandName', ''),
-                                    'name': value.get('displayName', ''),
-                                    'price': str(value.get('valuePrice', 0)),
-                                    'rating': str(value.get('rating', 0)),
-                                    'image': value.get('heroImage', '')
-                                }
-                                products.append(product)
-                        except Exception as e:
-                            logger.error(f"Error processing product from Apollo data: {e}")
+            # Look for products in the Apollo cache, keeping only nodes that look like products
+            apollo_products = [value for _, value in StateBlob(apollo_blob).object_items('')
+                               if isinstance(value, dict) and 'brandName' in value and 'displayName' in value]
+            if apollo_products:
+                debug_capture.save('apollo-state', apollo_products)
+            
+            for value in apollo_products:
+                try:
+                    product_id = value.get('productId', '')
+                    if product_id:
+                        product = {
+                            'url': f"/product/{product_id}",
+                            'brand': value.get('brandName', ''),
+                            'name': value.get('displayName', ''),
+                            'price': str(value.get('valuePrice', 0)),
+                            'rating': str(value.get('rating', 0)),
+                            'image': value.get('heroImage', '')
+                        }
+                        products.append(product)
+                except Exception as e:
+                    logger.error(f"Error processing product from Apollo data: {e}")
         except Exception as e:
             logger.error(f"Error extracting Apollo data: {e}")
     
@@ -320,65 +745,220 @@ def extract_rating_from_text(text):
     
     return 0
 
-def extract_product_data(product_el):
-    """Extract structured data from a product element"""
+class SoupDocument:
+    """
+    Parsed page backed by BeautifulSoup. This is the reference backend the
+    others must match; every backend exposes the same small interface and
+    works on its own native node type.
+    """
+    name = 'bs4'
+    
+    def __init__(self, html_content, features='html.parser'):
+        self.root = BeautifulSoup(html_content, features)
+    
+    def select(self, selector, node=None):
+        return (self.root if node is None else node).select(selector)
+    
+    def select_one(self, selector, node=None):
+        return (self.root if node is None else node).select_one(selector)
+    
+    def attr(self, node, name):
+        return node.get(name)
+    
+    def text(self, node):
+        return node.text
+    
+    def stripped_text(self, node=None):
+        return (self.root if node is None else node).get_text(strip=True)
+    
+    def json_ld_blocks(self):
+        return [script.string for script in self.root.find_all('script', type='application/ld+json') if script.string]
+    
+    def html(self, node):
+        return str(node)
+    
+    def links(self):
+        return [link.get('href', '') for link in self.root.find_all('a', href=True)]
+
+class SoupLxmlDocument(SoupDocument):
+    """BeautifulSoup tree built by the much faster lxml parser"""
+    name = 'bs4-lxml'
+    
+    def __init__(self, html_content):
+        super().__init__(html_content, 'lxml')
+
+# Like BeautifulSoup's get_text(), text helpers skip the contents of these tags
+HIDDEN_TEXT_TAGS = ('script', 'style', 'template')
+
+if lxml is not None:
+    LXML_VISIBLE_TEXT = lxml.etree.XPath(
+        './/text()[not(parent::script) and not(parent::style) and not(parent::template)]'
+    )
+
+@lru_cache(maxsize=256)
+def compiled_css(selector):
+    """Compile a CSS selector to an lxml XPath matcher once and reuse it"""
+    return CSSSelector(selector)
+
+class LxmlDocument:
+    """Parsed page backed by lxml.html with precompiled CSS selectors"""
+    name = 'lxml'
+    
+    def __init__(self, html_content):
+        try:
+            self.root = lxml.html.document_fromstring(html_content)
+        except ValueError:
+            # lxml refuses str input that carries an XML encoding declaration
+            self.root = lxml.html.document_fromstring(html_content.encode('utf-8'))
+    
+    def select(self, selector, node=None):
+        return compiled_css(selector)(self.root if node is None else node)
+    
+    def select_one(self, selector, node=None):
+        matches = self.select(selector, node)
+        return matches[0] if matches else None
+    
+    def attr(self, node, name):
+        return node.get(name)
+    
+    def text(self, node):
+        return ''.join(LXML_VISIBLE_TEXT(node))
+    
+    def stripped_text(self, node=None):
+        return ''.join(part.strip() for part in LXML_VISIBLE_TEXT(self.root if node is None else node))
+    
+    def json_ld_blocks(self):
+        return [script.text for script in self.select('script[type="application/ld+json"]') if script.text]
+    
+    def html(self, node):
+        return lxml.html.tostring(node, encoding='unicode')
+    
+    def links(self):
+        return [link.get('href', '') for link in self.select('a[href]')]
+
+class SelectolaxDocument:
+    """Parsed page backed by selectolax's Lexbor engine"""
+    name = 'selectolax'
+    
+    def __init__(self, html_content):
+        self.root = LexborHTMLParser(html_content)
+    
+    def select(self, selector, node=None):
+        return (self.root if node is None else node).css(selector)
+    
+    def select_one(self, selector, node=None):
+        return (self.root if node is None else node).css_first(selector)
+    
+    def attr(self, node, name):
+        return node.attributes.get(name)
+    
+    def visible_text(self, node):
+        for child in node.traverse(include_text=True):
+            if child.tag == '-text' and child.parent.tag not in HIDDEN_TEXT_TAGS:
+                yield child.text_content
+    
+    def text(self, node):
+        return ''.join(self.visible_text(node))
+    
+    def stripped_text(self, node=None):
+        node = self.root.root if node is None else node
+        return ''.join(part.strip() for part in self.visible_text(node))
+    
+    def json_ld_blocks(self):
+        return [text for text in (script.text(deep=True) for script in self.select('script[type="application/ld+json"]')) if text]
+    
+    def html(self, node):
+        return node.html
+    
+    def links(self):
+        return [link.attributes.get('href') or '' for link in self.select('a[href]')]
+
+PARSER_BACKENDS = {'bs4': SoupDocument}
+if lxml is not None:
+    PARSER_BACKENDS['bs4-lxml'] = SoupLxmlDocument
+    if CSSSelector is not None:
+        PARSER_BACKENDS['lxml'] = LxmlDocument
+if LexborHTMLParser is not None:
+    PARSER_BACKENDS['selectolax'] = SelectolaxDocument
+
+def default_parser_backend():
+    """Fastest backend that is installed"""
+    for name in ('selectolax', 'lxml', 'bs4-lxml', 'bs4'):
+        if name in PARSER_BACKENDS:
+            return name
+
+# Parser used for crawled pages; 'auto' picks the fastest installed backend
+PARSER_BACKEND = os.getenv("SCRAPER_PARSER", "auto")
+
+def parse_document(html_content, backend=None):
+    """Parse a page once with the configured backend"""
+    backend = backend or PARSER_BACKEND
+    if backend == 'auto':
+        backend = default_parser_backend()
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Parser backend '{backend}' is not available; installed: {', '.join(PARSER_BACKENDS)}")
+    return PARSER_BACKENDS[backend](html_content)
+
+# Selectors tried in order for each field of a product grid element
+PRODUCT_FIELD_SELECTORS = {
+    'brand': [
+        'span[data-at="sku_item_brand"]', 
+        '.css-cjz2sh', 
+        '.css-ktoumz',
+        '[data-comp="BrandName"]',
+        'span[data-at="brand_name"]'
+    ],
+    'name': [
+        'span[data-at="sku_item_name"]', 
+        '.css-bpsjlq', 
+        '.css-1n1cap4',
+        '[data-comp="DisplayName"]',
+        'span[data-at="product_name"]'
+    ],
+    'price': [
+        'span[data-at="sku_item_price_list"]', 
+        '.css-1nhzng0', 
+        '.css-o0sbai',
+        '[data-comp="Price"]',
+        'span[data-at="price"]'
+    ],
+    'rating': [
+        'div[data-at="sku_item_rating"]', 
+        '.css-1grx9ln', 
+        '.css-14lnvpw',
+        '[data-comp="StarRating"]',
+        'div[data-at="rating"]'
+    ]
+}
+
+def extract_product_data(product_el, document):
+    """Extract structured data from a product element of a parsed document"""
     product_data = {}
     
     # Extract URL - most critical piece
-    url = product_el.get('href', '')
+    url = document.attr(product_el, 'href') or ''
     if not url:
         return None
     product_data['url'] = url
     
     # Get full text content for extracting data
-    full_text = product_el.get_text(strip=True)
-    
-    # Extract data using a set of selectors for each field
-    selector_mapping = {
-        'brand': [
-            'span[data-at="sku_item_brand"]', 
-            '.css-cjz2sh', 
-            '.css-ktoumz',
-            '[data-comp="BrandName"]',
-            'span[data-at="brand_name"]'
-        ],
-        'name': [
-            'span[data-at="sku_item_name"]', 
-            '.css-bpsjlq', 
-            '.css-1n1cap4',
-            '[data-comp="DisplayName"]',
-            'span[data-at="product_name"]'
-        ],
-        'price': [
-            'span[data-at="sku_item_price_list"]', 
-            '.css-1nhzng0', 
-            '.css-o0sbai',
-            '[data-comp="Price"]',
-            'span[data-at="price"]'
-        ],
-        'rating': [
-            'div[data-at="sku_item_rating"]', 
-            '.css-1grx9ln', 
-            '.css-14lnvpw',
-            '[data-comp="StarRating"]',
-            'div[data-at="rating"]'
-        ]
-    }
+    full_text = document.stripped_text(product_el)
     
     # Process each field using the selectors
-    for field, selectors in selector_mapping.items():
+    for field, selectors in PRODUCT_FIELD_SELECTORS.items():
         for selector in selectors:
-            el = product_el.select_one(selector)
-            if el:
-                product_data[field] = el.text.strip()
+            el = document.select_one(selector, product_el)
+            if el is not None:
+                product_data[field] = document.text(el).strip()
                 break
     
     # Image extraction
-    img_el = product_el.select_one('img')
-    if img_el:
+    img_el = document.select_one('img', product_el)
+    if img_el is not None:
         for attr in ['src', 'data-src', 'data-default-src']:
-            if img_el.has_attr(attr) and img_el[attr]:
-                product_data['image'] = img_el[attr]
+            value = document.attr(img_el, attr)
+            if value:
+                product_data['image'] = value
                 break
     
     # Apply fallbacks for missing data
@@ -387,7 +967,8 @@ def extract_product_data(product_el):
         text_parts = full_text.split()
         if "Quicklook" in full_text and len(text_parts) > 1:
             start_idx = full_text.find("Quicklook") + len("Quicklook")
-            potential_brand = full_text[start_idx:].split()[0]
+            remainder = full_text[start_idx:].split()
+            potential_brand = remainder[0] if remainder else ''
             if potential_brand and potential_brand not in ["New", "Limited", "Online"]:
                 product_data['brand'] = potential_brand
     
@@ -406,268 +987,637 @@ def extract_product_data(product_el):
     
     return product_data
 
-def determine_working_pagination_pattern(category_url):
-    """Test different pagination patterns to find one that works"""
-    pagination_patterns = [
-        lambda p: f"{category_url}?currentPage={p}" if p > 1 else category_url,
-        lambda p: f"{category_url}?page={p}" if p > 1 else category_url,
-        lambda p: f"{category_url}&page={p}" if p > 1 else category_url
-    ]
+def extract_grid_products(document, page):
+    """Extract raw product data from the rendered product grid of a parsed page"""
+    product_elements = []
+    for selector in PRODUCT_SELECTOR_PATTERNS:
+        product_elements = document.select(selector)
+        if product_elements:
+            logger.info(f"Found {len(product_elements)} product elements using selector: {selector}")
+            break
+    
+    products = []
+    for idx, product_el in enumerate(product_elements):
+        try:
+            # Save this element's HTML for debugging
+            if debug_capture.active:
+                debug_capture.save(f'element-{idx}', document.html(product_el), 'html')
+            
+            # Extract data from the element
+            product_data = extract_product_data(product_el, document)
+            if not product_data or not product_data.get('url'):
+                logger.warning(f"Element {idx} has no valid product data")
+                continue
+            products.append(product_data)
+        except Exception as e:
+            logger.error(f"Error processing product element {idx}: {e}")
     
-    for pattern in pagination_patterns:
-        test_url = pattern(2)  # Test with page 2
+    return product_elements, products
+
+# URL schemes tried, in order, to reach page 2+ of a category
+PAGINATION_SCHEMES = {
+    'currentPage': lambda category_url, p: f"{category_url}?currentPage={p}",
+    'page': lambda category_url, p: f"{category_url}?page={p}",
+    'page-appended': lambda category_url, p: f"{category_url}&page={p}",
+}
+
+def pagination_pattern(category_url, scheme):
+    """Page number -> URL function for a category under a pagination scheme"""
+    build_url = PAGINATION_SCHEMES[scheme]
+    return lambda p: build_url(category_url, p) if p > 1 else category_url
+
+def determine_working_pagination_pattern(category_url, rate_limiter=None, probe_page=2):
+    """
+    Test the pagination schemes on `probe_page` (2 or later) to find one that
+    works. Returns (scheme, probe) where probe is the PageResult of the
+    successful request, so a crawl that includes that page does not fetch it
+    again, or None if no scheme worked.
+    """
+    for scheme in PAGINATION_SCHEMES:
+        test_url = pagination_pattern(category_url, scheme)(probe_page)
         logger.info(f"Testing pagination pattern: {test_url}")
         
-        response = get_page_with_retry(test_url)
+        response = get_page_with_retry(test_url, rate_limiter=rate_limiter)
         if not response:
             continue
             
         if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            if soup.select('a[href*="/product/"]'):
+            probe = response_page_result(response, category_url, probe_page)
+            if probe.products:
                 logger.info(f"Found working pagination pattern: {test_url}")
-                return pattern
+                return scheme, probe
     
     logger.error("Could not determine working pagination pattern")
     # Default to first pattern as fallback
-    return pagination_patterns[0]
+    return next(iter(PAGINATION_SCHEMES)), None
 
-def crawl_category_page(category_url, max_pages=10):
+NO_RESULTS_PATTERN = re.compile(r'no (results|products)', re.IGNORECASE)
+
+# Selector patterns tried in order to find product elements in the rendered grid
+PRODUCT_SELECTOR_PATTERNS = [
+    'a[href*="/product/"]',
+    'div[data-comp="ProductGrid"] a[href*="/product/"]',
+    'div[data-comp="Product"] a',
+    '.css-12egk0t a',
+    'li[data-comp="ProductItem"] a',
+    # Additional selectors for deeper searching
+    '[data-at="product_grid"] a',
+    '[data-comp="ProductGrid"] [data-at="sku_item"] a',
+    # More generic selectors for backup
+    'a[href*="skuId="]',
+    'a[href*="icid2=products"]'
+]
+
+def extract_page_products(html_content, category_url, page):
     """
-    Crawl a category page with improved handling of pagination, duplicates, and data extraction
+    Extract all products from one fetched category page.
+    Returns (products, end_of_results) where end_of_results is True when
+    the page says there are no more products.
     """
-    all_products = []
-    products_seen = {}  # Keep track of URLs we've already seen, with their data
+    with debug_capture.page(category_url, page, html_content):
+        return extract_products_from_html(html_content, category_url, page)
+
+def extract_products_from_html(html_content, category_url, page):
+    """
+    Sources are tried in order of reliability: embedded API data, JSON-LD,
+    then the rendered product grid. The page is parsed only once.
+    """
+    # Try to extract data from API embedded in page (priority)
+    api_products = extract_api_data(html_content)
+    products = [p for p in (process_product_data(product, category_url) for product in api_products) if p]
+    if products:
+        logger.info(f"Found {len(products)} products from embedded API data")
+        return products, False
     
-    # Find a working pagination pattern first
-    pagination_pattern = determine_working_pagination_pattern(category_url)
+    document = parse_document(html_content)
     
-    # Track consecutive empty pages to detect end of products
-    consecutive_empty_pages = 0
+    # Try to extract product data from JSON-LD
+    json_ld_products = extract_json_ld_products(document)
+    products = [p for p in (process_product_data(product, category_url) for product in json_ld_products if product) if p]
+    if products:
+        logger.info(f"Found {len(products)} products from JSON-LD")
+        return products, False
     
-    for page in range(1, max_pages + 1):
-        page_url = pagination_pattern(page)
-        logger.info(f"Crawling page {page}: {page_url}")
-        
-        # Get the page with retry logic
-        response = get_page_with_retry(page_url)
-        if not response:
-            logger.error(f"Failed to fetch page {page} after multiple retries")
-            consecutive_empty_pages += 1
-            if consecutive_empty_pages >= 2:
-                logger.warning(f"Multiple consecutive failures. Stopping pagination at page {page}.")
-                break
-            continue
-        
-        # Parse the HTML content
-        html_content = response.text
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Save HTML for debugging
-        debug_file = save_debug_html(html_content, page)
-        logger.info(f"Saved HTML to {debug_file} for further inspection")
-        
-        # Initialize a flag to track if any products were found on this page
-        products_found_on_page = False
+    # Fallback to HTML parsing
+    logger.info("Trying HTML parsing...")
+    
+    product_elements, grid_products = extract_grid_products(document, page)
+    
+    if not product_elements:
+        logger.warning(f"No product elements found on page {page}")
         
-        # Try to extract data from API embedded in page (priority)
-        api_products = extract_api_data(html_content)
-        if api_products:
-            logger.info(f"Found {len(api_products)} products from embedded API data")
-            for product in api_products:
-                processed = process_product_data(product, category_url)
-                if processed:
-                    product_link = processed['product_link']
-                    if product_link not in products_seen:
-                        products_seen[product_link] = processed
-                        all_products.append(processed)
-                        products_found_on_page = True
-                    elif should_update_product(products_seen[product_link], processed):
-                        # Update with better data
-                        update_product_in_list(all_products, products_seen[product_link], processed)
-                        products_seen[product_link] = processed
-                        products_found_on_page = True
+        # Try to handle pages with no products directly but with content
+        if page >= 5:
+            # Check if this is a pagination trap or end of products
+            # Look for "no results" indicators
+            page_text = document.stripped_text()
+            no_results_indicators = [
+                document.select('.css-no-results'),
+                document.select('.no-results'),
+                document.select('[data-at="no_search_results"]'),
+                NO_RESULTS_PATTERN.search(page_text),
+            ]
             
-            if products_found_on_page:
-                consecutive_empty_pages = 0
-                continue  # Skip HTML parsing if we got API data
-        
-        # Try to extract product data from JSON-LD
-        json_ld_products = extract_json_ld_products(soup)
-        if json_ld_products:
-            logger.info(f"Found {len(json_ld_products)} products from JSON-LD")
-            for product in json_ld_products:
-                processed = process_product_data(product, category_url)
-                if processed:
-                    product_link = processed['product_link']
-                    if product_link not in products_seen:
-                        products_seen[product_link] = processed
-                        all_products.append(processed)
-                        products_found_on_page = True
-                    elif should_update_product(products_seen[product_link], processed):
-                        update_product_in_list(all_products, products_seen[product_link], processed)
-                        products_seen[product_link] = processed
-                        products_found_on_page = True
+            if any(no_results_indicators):
+                logger.warning("Detected 'no results' indicator on page. Stopping pagination.")
+                return [], True
             
-            if products_found_on_page:
-                consecutive_empty_pages = 0
-                continue  # Skip HTML parsing if we got JSON-LD data
-        
-        # Fallback to HTML parsing
-        logger.info("Trying HTML parsing...")
+            # Try direct product extraction from page by looking for product patterns
+            logger.info("Attempting direct extraction of product references from page...")
+            
+            # Look for product links in href attributes
+            product_links = set()
+            for href in document.links():
+                if '/product/' in href and 'P' in href:
+                    product_links.add(href)
+            
+            if product_links:
+                logger.info(f"Found {len(product_links)} product links through direct extraction")
+                
+                for link in product_links:
+                    product_data = {
+                        'url': link,
+                        'brand': '',  # We'll need to fetch the product page to get these details
+                        'name': extract_name_from_url(link),
+                        'price': '',
+                        'rating': '',
+                        'image': ''
+                    }
+                    
+                    processed_product = process_product_data(product_data, category_url)
+                    if processed_product:
+                        products.append(processed_product)
         
-        # Try different selector patterns to find product elements
-        selector_patterns = [
-            'a[href*="/product/"]',
-            'div[data-comp="ProductGrid"] a[href*="/product/"]',
-            'div[data-comp="Product"] a',
-            '.css-12egk0t a',
-            'li[data-comp="ProductItem"] a',
-            # Additional selectors for deeper searching
-            '[data-at="product_grid"] a',
-            '[data-comp="ProductGrid"] [data-at="sku_item"] a',
-            # More generic selectors for backup
-            'a[href*="skuId="]',
-            'a[href*="icid2=products"]'
-        ]
+        return products, False
+    
+    for product_data in grid_products:
+        processed_product = process_product_data(product_data, category_url)
+        if processed_product:
+            products.append(processed_product)
+    
+    logger.info(f"Found {len(products)} valid products from HTML on page {page}")
+    return products, False
+
+PRODUCT_ID_PATTERN = re.compile(r'-(P\d+)(?:$|[/?#])')
+SKU_ID_PATTERN = re.compile(r'[?&]skuId=(\d+)')
+
+def product_key(product_link):
+    """
+    Dedup key for a product URL: its product id and SKU when the URL has them,
+    otherwise the URL without query string, fragment or trailing slash.
+    Tracking parameters such as icid2 therefore don't create duplicates.
+    """
+    product_id = PRODUCT_ID_PATTERN.search(product_link)
+    if product_id:
+        sku_id = SKU_ID_PATTERN.search(product_link)
+        return f"{product_id.group(1)}:{sku_id.group(1) if sku_id else ''}"
+    parsed = urlparse(product_link)
+    return f"{parsed.netloc.lower()}{parsed.path.rstrip('/')}"
+
+def completeness(product):
+    """Number of filled fields in a product record"""
+    return sum(1 for v in product.values() if v)
+
+class ProductStore:
+    """
+    Crawl results keyed by product_key, in first-seen order.
+    A product seen again is merged field by field: the more complete record
+    wins conflicting fields and the other fills its gaps. Completeness scores
+    are cached per key, so each merge is O(1) in the number of products.
+    """
+    
+    def __init__(self):
+        self.products = {}
+        self.scores = {}
+    
+    def __len__(self):
+        return len(self.products)
+    
+    def __iter__(self):
+        return iter(self.products.values())
+    
+    def add(self, product):
+        """Add or merge one product. Returns the stored record if it was new or filled in anything."""
+        key = product_key(product['product_link'])
+        existing = self.products.get(key)
+        score = completeness(product)
+        if existing is None:
+            self.products[key] = product
+            self.scores[key] = score
+            return product
         
-        product_elements = []
+        if score > self.scores[key]:
+            primary, fallback = product, existing
+        else:
+            primary, fallback = existing, product
+        merged = dict(primary)
+        for field, value in fallback.items():
+            if value and not merged.get(field):
+                merged[field] = value
+        # The link is the table's conflict key and may already have been written;
+        # another URL for the same product (e.g. different icid2) must not create a second row
+        merged['product_link'] = existing['product_link']
+        if merged == existing:
+            return None
         
-        for selector in selector_patterns:
-            product_elements = soup.select(selector)
-            if product_elements:
-                logger.info(f"Found {len(product_elements)} product elements using selector: {selector}")
-                break
+        self.products[key] = merged
+        self.scores[key] = completeness(merged)
+        return merged
+    
+    def merge(self, products):
+        """
+        Merge freshly extracted products into the store.
+        Returns the stored records that are new or better; empty when the
+        products added nothing.
+        """
+        changed = []
+        for product in products:
+            stored = self.add(product)
+            if stored is not None:
+                changed.append(stored)
+        return changed
+    
+    def valid_products(self):
+        """Final quality check; records are already unique"""
+        final_products = [product for product in self.products.values() if is_valid_product(product)]
+        logger.info(f"Found {len(final_products)} unique products after final filtering")
+        return final_products
+
+class SeenProducts:
+    """
+    Dedup state for streamed crawls: only each product's first link and
+    completeness score, so memory grows by a few bytes per product rather
+    than by whole records, which are already on their way to the database.
+    A later record is passed on when it is more complete than anything seen,
+    under the first link, so the upsert updates the row already written.
+    Unlike ProductStore it does not fill gaps from earlier records.
+    """
+    
+    def __init__(self):
+        self.seen = {}  # product_key -> (first product_link, best completeness)
+    
+    def __len__(self):
+        return len(self.seen)
+    
+    def add(self, product):
+        """Returns the record to write if the product is new or more complete, else None"""
+        key = product_key(product['product_link'])
+        score = completeness(product)
+        seen = self.seen.get(key)
+        if seen is None:
+            self.seen[key] = (product['product_link'], score)
+            return product
         
-        if not product_elements:
-            logger.warning(f"No product elements found on page {page}")
+        link, best = seen
+        if score <= best:
+            return None
+        self.seen[key] = (link, score)
+        return dict(product, product_link=link)
+    
+    def merge(self, products):
+        """Returns the records that are new or more complete"""
+        changed = []
+        for product in products:
+            record = self.add(product)
+            if record is not None:
+                changed.append(record)
+        return changed
+
+# Pages checkpointed within this many hours are reused without a request;
+# older ones are revalidated with a conditional request
+CHECKPOINT_PATH = os.getenv("SCRAPER_CHECKPOINT", "scraper_checkpoint.sqlite")
+RESUME_MAX_AGE_HOURS = float(os.getenv("SCRAPER_RESUME_HOURS", "12"))
+# How long a detected pagination scheme is trusted before probing again
+PAGINATION_MAX_AGE_HOURS = float(os.getenv("SCRAPER_PAGINATION_HOURS", "168"))
+
+class PageResult:
+    """Outcome of fetching one category page"""
+    
+    def __init__(self, products, end_of_results=False, status='fetched', etag=None, last_modified=None, content_hash=None):
+        self.products = products
+        self.end_of_results = end_of_results
+        self.status = status  # fetched, not-modified, unchanged, resumed or failed
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+
+def configure_parse_worker(parser_backend, debug_sample_rate, debug_dir, debug_run_id):
+    """Process pool initializer: apply the parent's parser and debug settings"""
+    global PARSER_BACKEND
+    PARSER_BACKEND = parser_backend
+    debug_capture.configure(sample_rate=debug_sample_rate, root=debug_dir, run_id=debug_run_id)
+
+def create_parse_pool(processes):
+    """Process pool for CPU-bound page parsing, or None to parse on the fetch threads"""
+    if processes <= 0:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=configure_parse_worker,
+        initargs=(PARSER_BACKEND, debug_capture.sample_rate, debug_capture.root, debug_capture.run_id)
+    )
+
+def parse_page_worker(html_content, category_url, page):
+    """Parse pool task; pool processes exit without running cleanup, so flush captures here"""
+    try:
+        return extract_page_products(html_content, category_url, page)
+    finally:
+        debug_capture.flush()
+
+def response_page_result(response, category_url, page, content_hash=None, parse_pool=None):
+    """
+    Extract a fetched page into a PageResult carrying its validators.
+    With a parse pool the fetch thread hands the HTML over and waits, so at
+    most one page per fetch worker is ever waiting to be parsed.
+    """
+    if parse_pool is not None:
+        products, end_of_results = parse_pool.submit(parse_page_worker, response.text, category_url, page).result()
+    else:
+        products, end_of_results = extract_page_products(response.text, category_url, page)
+    return PageResult(products, end_of_results, 'fetched',
+                      response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                      content_hash or hashlib.sha1(response.content).hexdigest())
+
+def checkpointed_result(row, status):
+    """PageResult holding the products saved for a page in the checkpoint"""
+    return PageResult(json.loads(row['products']), bool(row['end_of_results']), status,
+                      row['etag'], row['last_modified'], row['content_hash'])
+
+class CrawlCheckpoint:
+    """
+    SQLite record of fetched category pages: content hash, validators and the
+    products extracted from each. Lets a rerun skip pages it already completed
+    and re-crawls send conditional requests. Also remembers the pagination
+    scheme detected for each category.
+    Only used from the crawl coordinator thread.
+    """
+    
+    def __init__(self, path=CHECKPOINT_PATH, max_age_hours=RESUME_MAX_AGE_HOURS,
+                 pagination_max_age_hours=PAGINATION_MAX_AGE_HOURS):
+        self.path = path
+        self.max_age = max_age_hours * 3600
+        self.pagination_max_age = pagination_max_age_hours * 3600
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                category_url TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                content_hash TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                products TEXT NOT NULL,
+                end_of_results INTEGER NOT NULL DEFAULT 0,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pagination (
+                category TEXT PRIMARY KEY,
+                scheme TEXT NOT NULL,
+                detected_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+    
+    @staticmethod
+    def category_key(category_url):
+        parsed = urlparse(category_url)
+        return f"{parsed.netloc.lower()}{parsed.path.rstrip('/')}"
+    
+    def pagination_scheme(self, category_url):
+        """The category's pagination scheme if it was detected recently enough"""
+        row = self.connection.execute("SELECT scheme, detected_at FROM pagination WHERE category = ?",
+                                      (self.category_key(category_url),)).fetchone()
+        if row and row['scheme'] in PAGINATION_SCHEMES and time.time() - row['detected_at'] < self.pagination_max_age:
+            return row['scheme']
+        return None
+    
+    def save_pagination_scheme(self, category_url, scheme):
+        self.connection.execute("INSERT OR REPLACE INTO pagination VALUES (?, ?, ?)",
+                                (self.category_key(category_url), scheme, time.time()))
+        self.connection.commit()
+    
+    def forget_pagination_scheme(self, category_url):
+        self.connection.execute("DELETE FROM pagination WHERE category = ?", (self.category_key(category_url),))
+        self.connection.commit()
+    
+    def get(self, url):
+        return self.connection.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+    
+    def is_fresh(self, row):
+        return time.time() - row['fetched_at'] < self.max_age
+    
+    def save(self, url, category_url, page, result):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, category_url, page, result.content_hash, result.etag, result.last_modified,
+             json.dumps(result.products), int(result.end_of_results), time.time())
+        )
+        self.connection.commit()
+    
+    def close(self):
+        self.connection.close()
+
+class CategoryCrawl:
+    """Pagination and result state for one category in a concurrent crawl"""
+    
+    def __init__(self, category_url, start_page, max_pages, products=None):
+        self.category_url = category_url
+        self.pagination_pattern = None
+        self.cached_scheme = False
+        self.prefetched = {}  # page number -> PageResult fetched while probing pagination
+        self.next_page = start_page
+        self.last_page = start_page + max_pages - 1
+        self.page_found = {}  # page number -> whether it yielded new products
+        self.stopped = False
+        self.in_flight = 0
+        self.products = products if products is not None else ProductStore()
+    
+    def has_more_pages(self):
+        return self.pagination_pattern is not None and not self.stopped and self.next_page <= self.last_page
+    
+    def record_page(self, page, found, end_of_results):
+        # Stored as a bool so the `is False` checks below see empty pages
+        self.page_found[page] = bool(found)
+        if end_of_results:
+            self.stopped = True
+        # Pages complete out of order, so check both neighbours for a second empty page
+        elif not found and (self.page_found.get(page - 1) is False or self.page_found.get(page + 1) is False):
+            logger.warning(f"Multiple consecutive pages with no products. Stopping {self.category_url} at page {page}.")
+            self.stopped = True
+
+def fetch_and_extract_page(category_url, page_url, page, rate_limiter, cached=None, parse_pool=None):
+    """
+    Worker task: fetch one category page and extract its products.
+    `cached` is the page's checkpoint row; its validators make the request
+    conditional and its products are reused when the page has not changed.
+    """
+    logger.info(f"Crawling page {page}: {page_url}")
+    conditional_headers = {}
+    if cached is not None:
+        if cached['etag']:
+            conditional_headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            conditional_headers['If-Modified-Since'] = cached['last_modified']
+    
+    response = get_page_with_retry(page_url, rate_limiter=rate_limiter, extra_headers=conditional_headers)
+    if not response:
+        logger.error(f"Failed to fetch page {page} after multiple retries")
+        return PageResult([], status='failed')
+    
+    if response.status_code == 304:
+        logger.info(f"Page {page} not modified since last crawl")
+        return checkpointed_result(cached, 'not-modified')
+    
+    content_hash = hashlib.sha1(response.content).hexdigest()
+    if cached is not None and cached['content_hash'] == content_hash:
+        logger.info(f"Page {page} unchanged since last crawl")
+        result = checkpointed_result(cached, 'unchanged')
+        result.etag = response.headers.get('ETag')
+        result.last_modified = response.headers.get('Last-Modified')
+        return result
+    
+    return response_page_result(response, category_url, page, content_hash, parse_pool)
+
+def crawl_categories(category_urls, start_page=1, max_pages=15, workers=4, pages_per_category=2,
+                     rate_limiter=None, checkpoint=None, sink=None, parse_pool=None):
+    """
+    Crawl several categories concurrently on a thread pool.
+    Each category keeps up to `pages_per_category` page fetches in flight and
+    stops early once it runs out of products, while a shared per-host rate
+    limiter keeps the overall request rate polite.
+    With a checkpoint, pages completed recently are reused without a request
+    and older ones are revalidated, so an interrupted crawl resumes where it
+    stopped.
+    With a sink, new and improved products are streamed to it as pages
+    complete, deduplicated across categories, and only their keys are kept,
+    so memory stays flat however many products the crawl finds. A parse
+    pool moves HTML parsing off the fetch threads.
+    Returns a dict of category URL -> products, or with a sink, category
+    URL -> number of unique products.
+    """
+    rate_limiter = rate_limiter or HostRateLimiter()
+    # Probe pagination on the first paginated page the crawl fetches, so the probe is one of its pages
+    probe_page = max(2, start_page)
+    crawls = [CategoryCrawl(category_url, start_page, max_pages,
+                            SeenProducts() if sink is not None else None)
+              for category_url in category_urls]
+    all_products = SeenProducts()  # across categories, for the sink
+    page_statuses = {}
+    pending = {}
+    
+    def complete_page(crawl, page, result):
+        page_statuses[result.status] = page_statuses.get(result.status, 0) + 1
+        found = crawl.products.merge(result.products)
+        crawl.record_page(page, found, result.end_of_results)
+        if sink is not None and found:
+            sink.put(all_products.merge(found))
+    
+    def fill_window(crawl):
+        """Keep this category's page window full"""
+        while crawl.has_more_pages() and crawl.in_flight < pages_per_category:
+            page = crawl.next_page
+            crawl.next_page += 1
+            page_url = crawl.pagination_pattern(page)
             
-            # Try to handle pages with no products directly but with content
-            if page >= 5:
-                # Check if this is a pagination trap or end of products
-                # Look for "no results" indicators
-                no_results_indicators = [
-                    soup.select('.css-no-results'),
-                    soup.select('.no-results'),
-                    soup.select('[data-at="no_search_results"]'),
-                    soup.find_all(string=re.compile(r'no results', re.IGNORECASE)),
-                    soup.find_all(string=re.compile(r'no products', re.IGNORECASE))
-                ]
-                
-                if any(no_results_indicators):
-                    logger.warning("Detected 'no results' indicator on page. Stopping pagination.")
-                    break
-                
-                # Try direct product extraction from page by looking for product patterns
-                logger.info("Attempting direct extraction of product references from page...")
-                
-                # Look for product links in href attributes
-                product_links = set()
-                for link in soup.find_all('a', href=True):
-                    href = link.get('href', '')
-                    if '/product/' in href and 'P' in href:
-                        product_links.add(href)
-                
-                if product_links:
-                    logger.info(f"Found {len(product_links)} product links through direct extraction")
-                    
-                    for link in product_links:
-                        product_data = {
-                            'url': link,
-                            'brand': '',  # We'll need to fetch the product page to get these details
-                            'name': extract_name_from_url(link),
-                            'price': '',
-                            'rating': '',
-                            'image': ''
-                        }
-                        
-                        processed_product = process_product_data(product_data, category_url)
-                        if processed_product and processed_product['product_link'] not in products_seen:
-                            products_seen[processed_product['product_link']] = processed_product
-                            all_products.append(processed_product)
-                            products_found_on_page = True
+            if page in crawl.prefetched:
+                complete_page(crawl, page, crawl.prefetched.pop(page))
+                continue
             
-            consecutive_empty_pages += 1
-            if consecutive_empty_pages >= 2:
-                logger.warning(f"Multiple consecutive pages with no products. Stopping pagination at page {page}.")
-                break
+            cached = checkpoint.get(page_url) if checkpoint is not None else None
+            if cached is not None and checkpoint.is_fresh(cached):
+                logger.info(f"Page {page} of {crawl.category_url} already crawled, using checkpoint")
+                complete_page(crawl, page, checkpointed_result(cached, 'resumed'))
+                continue
             
-            continue
+            crawl.in_flight += 1
+            future = executor.submit(fetch_and_extract_page, crawl.category_url, page_url, page,
+                                     rate_limiter, cached, parse_pool)
+            pending[future] = (crawl, page, page_url)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Reuse remembered pagination schemes and detect the rest up front, in parallel
+        for crawl in crawls:
+            scheme = checkpoint.pagination_scheme(crawl.category_url) if checkpoint is not None else None
+            if scheme:
+                logger.info(f"Using saved pagination scheme '{scheme}' for {crawl.category_url}")
+                crawl.pagination_pattern = pagination_pattern(crawl.category_url, scheme)
+                crawl.cached_scheme = True
+                fill_window(crawl)
+            else:
+                future = executor.submit(determine_working_pagination_pattern, crawl.category_url, rate_limiter,
+                                         probe_page)
+                pending[future] = (crawl, None, None)
         
-        valid_products = []
-        for idx, product_el in enumerate(product_elements):
-            try:
-                # Save this element's HTML for debugging
-                element_file = save_element_debug(product_el, idx)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                crawl, page, page_url = pending.pop(future)
                 
-                # Extract data from the element
-                product_data = extract_product_data(product_el)
-                if not product_data or not product_data.get('url'):
-                    logger.warning(f"Element {idx} has no valid product data")
-                    continue
+                if page is None:
+                    try:
+                        scheme, probe = future.result()
+                    except Exception as e:
+                        logger.error(f"Error determining pagination for {crawl.category_url}: {e}")
+                        crawl.stopped = True
+                        continue
+                    
+                    crawl.pagination_pattern = pagination_pattern(crawl.category_url, scheme)
+                    if probe is not None:
+                        # The successful probe is a real fetch of probe_page
+                        if checkpoint is not None:
+                            checkpoint.save_pagination_scheme(crawl.category_url, scheme)
+                            checkpoint.save(crawl.pagination_pattern(probe_page), crawl.category_url, probe_page, probe)
+                        if probe_page <= crawl.last_page:
+                            crawl.prefetched[probe_page] = probe
+                else:
+                    crawl.in_flight -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Error crawling page {page} of {crawl.category_url}: {e}")
+                        result = PageResult([], status='failed')
+                    if checkpoint is not None and result.status != 'failed':
+                        checkpoint.save(page_url, crawl.category_url, page, result)
+                    complete_page(crawl, page, result)
                 
-                # Process the product data
-                processed_product = process_product_data(product_data, category_url)
-                if processed_product:
-                    product_link = processed_product['product_link']
-                    if product_link not in products_seen:
-                        products_seen[product_link] = processed_product
-                        valid_products.append(processed_product)
-                        products_found_on_page = True
-                    elif should_update_product(products_seen[product_link], processed_product):
-                        # Update existing with better data if current data is more complete
-                        products_seen[product_link] = processed_product
-                        # Need to update the entry in all_products too
-                        for i, p in enumerate(all_products):
-                            if p['product_link'] == product_link:
-                                all_products[i] = processed_product
-                                break
-                        products_found_on_page = True
-            except Exception as e:
-                logger.error(f"Error processing product element {idx}: {e}")
-        
-        logger.info(f"Found {len(valid_products)} valid products from HTML on page {page}")
-        all_products.extend(valid_products)
-        
-        if products_found_on_page:
-            consecutive_empty_pages = 0
-        else:
-            consecutive_empty_pages += 1
-            if consecutive_empty_pages >= 2:
-                logger.warning(f"Multiple consecutive pages with no products. Stopping pagination at page {page}.")
-                break
-        
-        # Add delay between pages with jitter
-        if page < max_pages:
-            delay = random.uniform(4, 8)
-            logger.info(f"Waiting {delay:.2f} seconds before next page...")
-            time.sleep(delay)
-    
-    # Final deduplication and quality check
-    final_products = []
-    seen_urls = set()
-    
-    for product in all_products:
-        url = product['product_link']
-        if url not in seen_urls and is_valid_product(product):
-            seen_urls.add(url)
-            final_products.append(product)
-    
-    logger.info(f"Found {len(final_products)} unique products after final filtering")
-    return final_products
-
-def extract_json_ld_products(soup):
+                fill_window(crawl)
+    
+    # A saved scheme that yields nothing may have gone stale; probe again next run
+    if checkpoint is not None:
+        for crawl in crawls:
+            if crawl.cached_scheme and not len(crawl.products):
+                checkpoint.forget_pagination_scheme(crawl.category_url)
+    
+    logger.info(f"Crawled pages by outcome: {page_statuses}")
+    if sink is not None:
+        return {crawl.category_url: len(crawl.products) for crawl in crawls}
+    return {crawl.category_url: crawl.products.valid_products() for crawl in crawls}
+
+def crawl_category_page(category_url, max_pages=10):
+    """
+    Crawl a category page with improved handling of pagination, duplicates, and data extraction
+    """
+    return crawl_from_specific_page(category_url, start_page=1, max_pages=max_pages)
+
+def extract_json_ld_products(document):
     """Extract product data from JSON-LD scripts in the page"""
     products = []
-    script_tags = soup.find_all('script', type='application/ld+json')
     
-    for script in script_tags:
+    for script_text in document.json_ld_blocks():
         try:
-            json_data = json.loads(script.string)
+            json_data = json.loads(script_text)
             logger.info(f"Found JSON-LD data: {json_data.get('@type', 'unknown type')}")
             
             # Save the JSON-LD data for debugging
-            save_debug_json(json_data, f"json_ld_data_{hash(script.string)}")
+            debug_capture.save('json-ld', json_data)
             
             # Handle different JSON-LD structures
             if isinstance(json_data, list):
@@ -712,31 +1662,6 @@ def process_json_ld_product(product):
         logger.error(f"Error processing JSON-LD product: {e}")
         return None
 
-def should_update_product(existing, new_product):
-    """Determine if we should update an existing product with new data"""
-    # If new product has more non-empty fields
-    existing_filled = sum(1 for v in existing.values() if v)
-    new_filled = sum(1 for v in new_product.values() if v)
-    
-    # If new product has more information, update
-    if new_filled > existing_filled:
-        return True
-    
-    # If new product has brand or name when existing doesn't
-    if (not existing.get('brand') and new_product.get('brand')) or \
-       (not existing.get('product_name') and new_product.get('product_name')):
-        return True
-    
-    return False
-
-def update_product_in_list(product_list, old_product, new_product):
-    """Update a product in the list with new data"""
-    for i, product in enumerate(product_list):
-        if product['product_link'] == old_product['product_link']:
-            product_list[i] = new_product
-            return True
-    return False
-
 def is_valid_product(product):
     """Check if a product has enough valid data to be considered useful"""
     # Must have a valid URL
@@ -867,321 +1792,332 @@ def extract_product_type(category_url):
         return ' '.join(word.capitalize() for word in last_part.split('-'))
     return "Makeup"
 
+def notify_cache_invalidation(scope=None):
+    """Tell the API server to drop its cached catalog responses"""
+    backend_url = os.getenv("BACKEND_URL")
+    token = os.getenv("CACHE_INVALIDATE_TOKEN")
+    if not backend_url or not token:
+        logger.info("BACKEND_URL or CACHE_INVALIDATE_TOKEN not set, skipping cache invalidation")
+        return False
+
+    try:
+        response = requests.post(
+            f"{backend_url.rstrip('/')}/cache/invalidate",
+            headers={"Authorization": f"Bearer {token}"},
+            params={"scope": scope} if scope else None,
+            timeout=10
+        )
+        if response.status_code == 200:
+            logger.info(f"Invalidated API cache: {response.json()}")
+            return True
+        logger.warning(f"Cache invalidation failed: {response.status_code} {response.text}")
+    except Exception as e:
+        logger.warning(f"Error invalidating API cache: {e}")
+    return False
+
+# Upsert batches are sized by JSON payload, starting at UPSERT_BATCH_BYTES and
+# adapting between the min and max to keep each request near the target time
+UPSERT_BATCH_BYTES = int(os.getenv("SCRAPER_UPSERT_BATCH_BYTES", str(256 * 1024)))
+UPSERT_MIN_BATCH_BYTES = 16 * 1024
+UPSERT_MAX_BATCH_BYTES = 4 * 1024 * 1024
+UPSERT_TARGET_SECONDS = 1.0
+UPSERT_CONCURRENCY = int(os.getenv("SCRAPER_UPSERT_CONCURRENCY", "4"))
+
+class BulkWriter:
+    """
+    Upserts rows into a table in as few requests as possible.
+    Rows are deduplicated on the conflict column, packed into batches by
+    payload size and sent with up to `concurrency` batches in flight. The
+    batch size grows while requests are fast and shrinks when they are slow
+    or fail. A rejected batch is split in half until the bad rows are
+    isolated, which costs O(log n) extra requests per bad row instead of one
+    request per row.
+    """
+    
+    def __init__(self, table, on_conflict, client=None, batch_bytes=UPSERT_BATCH_BYTES,
+                 concurrency=UPSERT_CONCURRENCY):
+        self.table = table
+        self.on_conflict = on_conflict
+        self.client = client or supabase
+        self.batch_bytes = batch_bytes
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.requests = 0
+    
+    def upsert(self, rows):
+        with self.lock:
+            self.requests += 1
+        (
+            self.client.table(self.table)
+            .upsert(rows, on_conflict=self.on_conflict, returning=ReturnMethod.minimal)
+            .execute()
+        )
+    
+    def adapt(self, elapsed, ok):
+        """Resize future batches from how the last request went"""
+        with self.lock:
+            if ok and elapsed < UPSERT_TARGET_SECONDS / 2:
+                self.batch_bytes = min(self.batch_bytes * 2, UPSERT_MAX_BATCH_BYTES)
+            elif not ok or elapsed > UPSERT_TARGET_SECONDS * 2:
+                self.batch_bytes = max(self.batch_bytes // 2, UPSERT_MIN_BATCH_BYTES)
+    
+    def write_batch(self, rows):
+        """Upsert one batch, bisecting on failure. Returns (successful, failed)."""
+        start = time.perf_counter()
+        try:
+            self.upsert(rows)
+            self.adapt(time.perf_counter() - start, True)
+            return len(rows), 0
+        except Exception as e:
+            self.adapt(time.perf_counter() - start, False)
+            if len(rows) == 1:
+                logger.error(f"Error storing {rows[0].get(self.on_conflict, 'unknown')}: {e}")
+                return 0, 1
+            if not isinstance(e, APIError):
+                # Connection problems are not caused by a row, so retry once as a whole
+                logger.warning(f"Error storing batch of {len(rows)} rows, retrying: {e}")
+                time.sleep(random.uniform(1, 2))
+                try:
+                    self.upsert(rows)
+                    return len(rows), 0
+                except Exception as retry_e:
+                    logger.warning(f"Retry failed, splitting batch: {retry_e}")
+        
+        middle = len(rows) // 2
+        left = self.write_batch(rows[:middle])
+        right = self.write_batch(rows[middle:])
+        return left[0] + right[0], left[1] + right[1]
+    
+    def batches(self, rows):
+        """Yield batches of at most the current batch size in JSON bytes"""
+        batch = []
+        size = 2
+        for row in rows:
+            row_size = len(json.dumps(row)) + 1
+            if batch and size + row_size > self.batch_bytes:
+                yield batch
+                batch = []
+                size = 2
+            batch.append(row)
+            size += row_size
+        if batch:
+            yield batch
+    
+    def write(self, rows):
+        """Upsert all rows. Returns (successful, failed)."""
+        # The same key twice in one upsert is rejected by Postgres; the last row wins
+        unique_rows = list({row[self.on_conflict]: row for row in rows}.values())
+        if len(unique_rows) < len(rows):
+            logger.info(f"Dropped {len(rows) - len(unique_rows)} duplicate {self.on_conflict} values")
+        
+        successful = 0
+        failed = 0
+        start = time.perf_counter()
+        batches = self.batches(unique_rows)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = set()
+            for batch in batches:
+                pending.add(executor.submit(self.write_batch, batch))
+                if len(pending) >= self.concurrency:
+                    break
+            
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ok, bad = future.result()
+                    successful += ok
+                    failed += bad
+                    # Batches are cut lazily so they pick up the adapted size
+                    batch = next(batches, None)
+                    if batch is not None:
+                        pending.add(executor.submit(self.write_batch, batch))
+        
+        elapsed = time.perf_counter() - start
+        logger.info(f"Upserted {successful} rows into {self.table} ({failed} failed) "
+                    f"in {elapsed:.2f}s using {self.requests} requests")
+        return successful, failed
+
+def product_row(product):
+    """sephoraproducts row for a processed product"""
+    return {
+        'brand': product.get('brand', ''),
+        'name': product.get('product_name', ''),
+        'link': product.get('product_link', ''),
+        'type': product.get('product_type', 'Blush'),
+        'image': product.get('product_image', ''),
+        'price': product.get('price', 0),
+        'rating': product.get('rating', 0)
+    }
+
+# Streaming writes: rows waiting for the writer before the crawl blocks, and
+# how often a partial batch is flushed so products show up during the crawl
+SINK_QUEUE_SIZE = 5000
+SINK_FLUSH_ROWS = 500
+SINK_FLUSH_SECONDS = 5.0
+
+class ProductSink:
+    """
+    Bounded queue between the crawl and the database. A background thread
+    collects valid products into batches and upserts them with a BulkWriter
+    while pages are still being fetched; when the writer falls behind, put()
+    blocks and slows the crawl instead of growing memory.
+    """
+    
+    def __init__(self, writer=None, queue_size=SINK_QUEUE_SIZE, flush_rows=SINK_FLUSH_ROWS,
+                 flush_seconds=SINK_FLUSH_SECONDS):
+        self.writer = writer or BulkWriter("sephoraproducts", on_conflict="link")
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.successful = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, name='product-sink', daemon=True)
+        self.thread.start()
+    
+    def put(self, products):
+        for product in products:
+            if is_valid_product(product):
+                self.queue.put(product_row(product))
+    
+    def flush(self, rows):
+        successful, failed = self.writer.write(rows)
+        self.successful += successful
+        self.failed += failed
+    
+    def run(self):
+        rows = []
+        deadline = time.monotonic() + self.flush_seconds
+        done = False
+        while not done:
+            try:
+                row = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if row is None:
+                    done = True
+                else:
+                    rows.append(row)
+            except queue.Empty:
+                pass
+            
+            if rows and (done or len(rows) >= self.flush_rows or time.monotonic() >= deadline):
+                try:
+                    self.flush(rows)
+                except Exception as e:
+                    logger.error(f"Error writing {len(rows)} products: {e}")
+                    self.failed += len(rows)
+                rows = []
+            if not rows:
+                deadline = time.monotonic() + self.flush_seconds
+    
+    def close(self):
+        """Write what is left and return (successful, failed)"""
+        self.queue.put(None)
+        self.thread.join()
+        return self.successful, self.failed
+
 def store_products(products):
     """Store products in Supabase database with better error handling"""
     if not products:
         logger.warning("No products to store")
         return 0, 0
-        
-    successful = 0
-    failed = 0
     
     logger.info(f"Storing {len(products)} products in database")
     
-    # Group products for batch insertion
-    batch_size = 10
-    product_batches = [products[i:i+batch_size] for i in range(0, len(products), batch_size)]
+    rows = [product_row(product) for product in products]
     
-    for batch_idx, batch in enumerate(product_batches):
-        logger.info(f"Processing batch {batch_idx+1}/{len(product_batches)}")
-        batch_data = []
-        
-        for product in batch:
-            data = {
-                'brand': product.get('brand', ''),
-                'name': product.get('product_name', ''),
-                'link': product.get('product_link', ''),
-                'type': product.get('product_type', 'Blush'),
-                'image': product.get('product_image', ''),
-                'price': product.get('price', 0),
-                'rating': product.get('rating', 0)
-            }
-            batch_data.append(data)
-        
-        try:
-            # Use upsert to handle duplicate links
-            response = (
-                supabase.table("sephoraproducts")
-                .upsert(batch_data, on_conflict="link")
-                .execute()
-            )
-            successful += len(batch_data)
-            logger.info(f"Successfully stored batch {batch_idx+1}")
-        except Exception as e:
-            logger.error(f"Error storing batch {batch_idx+1}: {e}")
-            # Try inserting one by one to identify problematic products
-            for product_data in batch_data:
-                try:
-                    supabase.table("sephoraproducts").upsert(product_data, on_conflict="link").execute()
-                    successful += 1
-                except Exception as product_e:
-                    logger.error(f"Error storing product {product_data.get('name', 'unknown')}: {product_e}")
-                    failed += 1
-        
-        # Add delay between batches to avoid overloading the database
-        if batch_idx < len(product_batches) - 1:
-            time.sleep(1)
+    # Use upsert to handle duplicate links
+    successful, failed = BulkWriter("sephoraproducts", on_conflict="link").write(rows)
+    
+    if successful:
+        notify_cache_invalidation()
     
     return successful, failed
 
 def main():
+    global SESSION_POOL_SIZE, SESSION_KEEP_ALIVE, PARSER_BACKEND
+    
+    parser = argparse.ArgumentParser(description='Crawl Sephora makeup categories into Supabase')
+    parser.add_argument('--categories', nargs='+', default=['blush'],
+                        help='Category slugs or URLs to crawl (default: blush)')
+    parser.add_argument('--all-categories', action='store_true', help='Crawl every makeup category')
+    parser.add_argument('--start-page', type=int, default=3, help='First page to crawl in each category')
+    parser.add_argument('--max-pages', type=int, default=15, help='Maximum pages per category')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent fetch workers')
+    parser.add_argument('--rate', type=float, default=0.25, help='Requests per second per host')
+    parser.add_argument('--pool-size', type=int, default=SESSION_POOL_SIZE,
+                        help='Connection pool size of each worker session')
+    parser.add_argument('--no-keep-alive', action='store_true',
+                        help='Close connections after every request (for comparison)')
+    parser.add_argument('--parser', default=PARSER_BACKEND, choices=['auto'] + list(PARSER_BACKENDS),
+                        help='HTML parser backend (default: fastest installed)')
+    parser.add_argument('--debug-sample', type=float, default=DEBUG_SAMPLE_RATE,
+                        help='Fraction of pages to capture for debugging (default: off)')
+    parser.add_argument('--debug-dir', default=DEBUG_OUTPUT_DIR, help='Where debug captures are written')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH, help='SQLite file recording crawled pages')
+    parser.add_argument('--no-checkpoint', action='store_true', help='Crawl every page without resuming')
+    parser.add_argument('--resume-hours', type=float, default=RESUME_MAX_AGE_HOURS,
+                        help='Reuse checkpointed pages younger than this; older ones are revalidated')
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        help='Parse pages in this many processes (default: on the fetch threads)')
+    args = parser.parse_args()
+    
+    SESSION_POOL_SIZE = args.pool_size
+    SESSION_KEEP_ALIVE = not args.no_keep_alive
+    PARSER_BACKEND = args.parser
+    debug_capture.configure(sample_rate=args.debug_sample, root=args.debug_dir)
+    
     # Verify the table exists
     ensure_table_exists()
     
-    # Define the category URL for blush products
-    # Use the base URL for pagination handling
-    category_url = "https://www.sephora.com/shop/blush"
-    
-    # Alternatively, you can specify a specific starting page
-    # starting_url = "https://www.sephora.com/shop/blush?currentPage=3"
-    
-    # Number of pages to crawl (adjust as needed)
-    max_pages = 15  # Increased to capture more blush products
-    
-    # Starting page (default is 1)
-    start_page = 3  # Starting from page 3 as specified
-    
-    # Create debug directory if it doesn't exist
-    os.makedirs("debug_output", exist_ok=True)
-    
-    logger.info(f"Starting to crawl: {category_url} from page {start_page}")
+    if args.all_categories:
+        category_urls = MAKEUP_CATEGORIES
+    else:
+        category_urls = [c if c.startswith('http') else f"https://www.sephora.com/shop/{c}" for c in args.categories]
     
-    # Modified to use a custom function for starting from a specific page
-    products = crawl_from_specific_page(category_url, start_page=start_page, max_pages=max_pages)
+    logger.info(f"Starting to crawl {len(category_urls)} categories from page {args.start_page}")
     
-    if products:
-        logger.info(f"\nFound {len(products)} blush products")
-        successful, failed = store_products(products)
+    # Products are written while the crawl runs instead of all at the end
+    checkpoint = None if args.no_checkpoint else CrawlCheckpoint(args.checkpoint, args.resume_hours)
+    parse_pool = create_parse_pool(args.parse_processes)
+    sink = ProductSink()
+    try:
+        results = crawl_categories(
+            category_urls,
+            start_page=args.start_page,
+            max_pages=args.max_pages,
+            workers=args.workers,
+            rate_limiter=HostRateLimiter(rate=args.rate),
+            checkpoint=checkpoint,
+            sink=sink,
+            parse_pool=parse_pool
+        )
+    finally:
+        successful, failed = sink.close()
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        if checkpoint is not None:
+            checkpoint.close()
+    
+    fetch_stats.log_summary()
+    debug_capture.close()
+    
+    for category_url, product_count in results.items():
+        logger.info(f"Found {product_count} products in {category_url}")
+    
+    if successful or failed:
+        if successful:
+            notify_cache_invalidation()
         
         logger.info(f"\nScraping complete!")
         logger.info(f"Successfully stored: {successful}")
         logger.info(f"Failed to store: {failed}")
     else:
-        logger.warning("No blush products found")
+        logger.warning("No products found")
 
-def crawl_from_specific_page(category_url, start_page=1, max_pages=15):
-    """Crawl starting from a specific page number"""
-    all_products = []
-    products_seen = {}  # Keep track of URLs we've already seen, with their data
-    
-    # Find a working pagination pattern first
-    pagination_pattern = determine_working_pagination_pattern(category_url)
-    
-    # Track consecutive empty pages to detect end of products
-    consecutive_empty_pages = 0
-    
-    # Adjust the range to start from the specified page
-    for page in range(start_page, start_page + max_pages):
-        page_url = pagination_pattern(page)
-        logger.info(f"Crawling page {page}: {page_url}")
-        
-        # Rest of the crawling logic from crawl_category_page
-        # Get the page with retry logic
-        response = get_page_with_retry(page_url)
-        if not response:
-            logger.error(f"Failed to fetch page {page} after multiple retries")
-            consecutive_empty_pages += 1
-            if consecutive_empty_pages >= 2:
-                logger.warning(f"Multiple consecutive failures. Stopping pagination at page {page}.")
-                break
-            continue
-        
-        # Parse the HTML content
-        html_content = response.text
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Save HTML for debugging
-        debug_file = save_debug_html(html_content, page)
-        logger.info(f"Saved HTML to {debug_file} for further inspection")
-        
-        # Initialize a flag to track if any products were found on this page
-        products_found_on_page = False
-        
-        # Try to extract data from API embedded in page (priority)
-        api_products = extract_api_data(html_content)
-        if api_products:
-            logger.info(f"Found {len(api_products)} products from embedded API data")
-            for product in api_products:
-                processed = process_product_data(product, category_url)
-                if processed:
-                    product_link = processed['product_link']
-                    if product_link not in products_seen:
-                        products_seen[product_link] = processed
-                        all_products.append(processed)
-                        products_found_on_page = True
-                    elif should_update_product(products_seen[product_link], processed):
-                        # Update with better data
-                        update_product_in_list(all_products, products_seen[product_link], processed)
-                        products_seen[product_link] = processed
-                        products_found_on_page = True
-            
-            if products_found_on_page:
-                consecutive_empty_pages = 0
-                continue  # Skip HTML parsing if we got API data
-        
-        # Try to extract product data from JSON-LD
-        json_ld_products = extract_json_ld_products(soup)
-        if json_ld_products:
-            logger.info(f"Found {len(json_ld_products)} products from JSON-LD")
-            for product in json_ld_products:
-                processed = process_product_data(product, category_url)
-                if processed:
-                    product_link = processed['product_link']
-                    if product_link not in products_seen:
-                        products_seen[product_link] = processed
-                        all_products.append(processed)
-                        products_found_on_page = True
-                    elif should_update_product(products_seen[product_link], processed):
-                        update_product_in_list(all_products, products_seen[product_link], processed)
-                        products_seen[product_link] = processed
-                        products_found_on_page = True
-            
-            if products_found_on_page:
-                consecutive_empty_pages = 0
-                continue  # Skip HTML parsing if we got JSON-LD data
-        
-        # Fallback to HTML parsing
-        logger.info("Trying HTML parsing...")
-        
-        # Try different selector patterns to find product elements
-        selector_patterns = [
-            'a[href*="/product/"]',
-            'div[data-comp="ProductGrid"] a[href*="/product/"]',
-            'div[data-comp="Product"] a',
-            '.css-12egk0t a',
-            'li[data-comp="ProductItem"] a',
-            # Additional selectors for deeper searching
-            '[data-at="product_grid"] a',
-            '[data-comp="ProductGrid"] [data-at="sku_item"] a',
-            # More generic selectors for backup
-            'a[href*="skuId="]',
-            'a[href*="icid2=products"]'
-        ]
-        
-        product_elements = []
-        
-        for selector in selector_patterns:
-            product_elements = soup.select(selector)
-            if product_elements:
-                logger.info(f"Found {len(product_elements)} product elements using selector: {selector}")
-                break
-        
-        if not product_elements:
-            logger.warning(f"No product elements found on page {page}")
-            
-            # Try to handle pages with no products directly but with content
-            if page >= 5:
-                # Check if this is a pagination trap or end of products
-                # Look for "no results" indicators
-                no_results_indicators = [
-                    soup.select('.css-no-results'),
-                    soup.select('.no-results'),
-                    soup.select('[data-at="no_search_results"]'),
-                    soup.find_all(string=re.compile(r'no results', re.IGNORECASE)),
-                    soup.find_all(string=re.compile(r'no products', re.IGNORECASE))
-                ]
-                
-                if any(no_results_indicators):
-                    logger.warning("Detected 'no results' indicator on page. Stopping pagination.")
-                    break
-                
-                # Try direct product extraction from page by looking for product patterns
-                logger.info("Attempting direct extraction of product references from page...")
-                
-                # Look for product links in href attributes
-                product_links = set()
-                for link in soup.find_all('a', href=True):
-                    href = link.get('href', '')
-                    if '/product/' in href and 'P' in href:
-                        product_links.add(href)
-                
-                if product_links:
-                    logger.info(f"Found {len(product_links)} product links through direct extraction")
-                    
-                    for link in product_links:
-                        product_data = {
-                            'url': link,
-                            'brand': '',  # We'll need to fetch the product page to get these details
-                            'name': extract_name_from_url(link),
-                            'price': '',
-                            'rating': '',
-                            'image': ''
-                        }
-                        
-                        processed_product = process_product_data(product_data, category_url)
-                        if processed_product and processed_product['product_link'] not in products_seen:
-                            products_seen[processed_product['product_link']] = processed_product
-                            all_products.append(processed_product)
-                            products_found_on_page = True
-            
-            consecutive_empty_pages += 1
-            if consecutive_empty_pages >= 2:
-                logger.warning(f"Multiple consecutive pages with no products. Stopping pagination at page {page}.")
-                break
-            
-            continue
-        
-        valid_products = []
-        for idx, product_el in enumerate(product_elements):
-            try:
-                # Save this element's HTML for debugging
-                element_file = save_element_debug(product_el, idx)
-                
-                # Extract data from the element
-                product_data = extract_product_data(product_el)
-                if not product_data or not product_data.get('url'):
-                    logger.warning(f"Element {idx} has no valid product data")
-                    continue
-                
-                # Process the product data
-                processed_product = process_product_data(product_data, category_url)
-                if processed_product:
-                    product_link = processed_product['product_link']
-                    if product_link not in products_seen:
-                        products_seen[product_link] = processed_product
-                        valid_products.append(processed_product)
-                        products_found_on_page = True
-                    elif should_update_product(products_seen[product_link], processed_product):
-                        # Update existing with better data if current data is more complete
-                        products_seen[product_link] = processed_product
-                        # Need to update the entry in all_products too
-                        for i, p in enumerate(all_products):
-                            if p['product_link'] == product_link:
-                                all_products[i] = processed_product
-                                break
-                        products_found_on_page = True
-            except Exception as e:
-                logger.error(f"Error processing product element {idx}: {e}")
-        
-        logger.info(f"Found {len(valid_products)} valid products from HTML on page {page}")
-        all_products.extend(valid_products)
-        
-        if products_found_on_page:
-            consecutive_empty_pages = 0
-        else:
-            consecutive_empty_pages += 1
-            if consecutive_empty_pages >= 2:
-                logger.warning(f"Multiple consecutive pages with no products. Stopping pagination at page {page}.")
-                break
-        
-        # Add delay between pages with jitter
-        if page < start_page + max_pages - 1:
-            delay = random.uniform(4, 8)
-            logger.info(f"Waiting {delay:.2f} seconds before next page...")
-            time.sleep(delay)
-    
-    # Final deduplication and quality check
-    final_products = []
-    seen_urls = set()
-    
-    for product in all_products:
-        url = product['product_link']
-        if url not in seen_urls and is_valid_product(product):
-            seen_urls.add(url)
-            final_products.append(product)
-    
-    logger.info(f"Found {len(final_products)} unique products after final filtering")
-    return final_products
+def crawl_from_specific_page(category_url, start_page=1, max_pages=15, checkpoint=None):
+    """Crawl one category, one page at a time, starting from a specific page number"""
+    results = crawl_categories([category_url], start_page=start_page, max_pages=max_pages,
+                               workers=1, pages_per_category=1, checkpoint=checkpoint)
+    return results[category_url]
 
 if __name__ == "__main__":
     try:
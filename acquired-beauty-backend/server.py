@@ -1,8 +1,22 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import asyncio
+import bisect
+import hashlib
+import heapq
+import hmac
+import itertools
+import re
+import threading
+import time
+import unicodedata
 import os
+import json
 import numpy as np
 from dotenv import load_dotenv
 import traceback
@@ -26,6 +40,44 @@ logger.info(f"Supabase Key: {supabase_key[:5]}...{supabase_key[-5:] if supabase_
 
 supabase: Client = create_client(supabase_url, supabase_key)
 
+# The supabase client is synchronous, so queries run on a bounded pool of
+# worker threads instead of blocking the event loop for the whole round-trip
+SUPABASE_MAX_WORKERS = int(os.getenv("SUPABASE_MAX_WORKERS", "16"))
+supabase_executor = ThreadPoolExecutor(max_workers=SUPABASE_MAX_WORKERS, thread_name_prefix="supabase")
+
+async def run_blocking(func, *args):
+    """Run a blocking call (usually a supabase .execute()) on the supabase thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(supabase_executor, func, *args)
+
+# Rows per request when reading a whole table; Supabase caps responses at 1000 rows by default
+SUPABASE_PAGE_SIZE = int(os.getenv("SUPABASE_PAGE_SIZE", "1000"))
+
+def fetch_all_rows(table: str, columns: str = "*", key: str = "id", page_size: int = SUPABASE_PAGE_SIZE,
+                   filters: Optional[Dict[str, str]] = None, after=None) -> List[Dict]:
+    """
+    Every row of a table matching the equality `filters`, paged by `key` and
+    starting after `after` if given. A single select is silently cut off at
+    PostgREST's max-rows limit, so whole-table reads go through here.
+    Paging stops at the first empty page rather than a short one, in case
+    the server's limit is below page_size.
+    """
+    rows = []
+    last_key = after
+    while True:
+        query = supabase.table(table).select(columns)
+        for column, value in (filters or {}).items():
+            query = query.eq(column, value)
+        query = query.order(key).limit(page_size)
+        if last_key is not None:
+            query = query.gt(key, last_key)
+        response = query.execute()
+        page = response.data if hasattr(response, 'data') and response.data else []
+        if not page:
+            return rows
+        rows.extend(page)
+        last_key = page[-1][key]
+
 app = FastAPI()
 
 # Add CORS middleware
@@ -35,6 +87,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Embedding-Count", "X-Embedding-Dimension", "X-Embedding-Format"],
 )
 
 class QuizResult(BaseModel):
@@ -54,6 +107,9 @@ class QuizResult(BaseModel):
 # Define the vector size for embeddings (should match the product embeddings)
 VECTOR_SIZE = 128
 
+# Largest number of quiz results accepted by /generate-embeddings:batch
+MAX_BATCH_SIZE = 10000
+
 # Define mappings matching those in the product embedding script
 SKIN_TONE_MAPPING = {
     'fair': [1.0, 0.0, 0.0, 0.0, 0.0, 0.0],
@@ -83,6 +139,45 @@ SKIN_TYPE_MAPPING = {
     'normal': [0.0, 0.0, 1.0, 0.0],
 }
 
+LIP_PRODUCT_MAPPING = {
+    'lipstick': [1.0, 0.0, 0.0, 0.0],
+    'gloss': [0.0, 1.0, 0.0, 0.0],
+    'stain': [0.0, 0.0, 1.0, 0.0],
+    'balm': [0.0, 0.0, 0.0, 1.0],
+}
+
+MAKEUP_STYLE_MAPPING = {
+    'natural': [1.0, 0.0, 0.0, 0.0],
+    'minimal': [0.7, 0.3, 0.0, 0.0],
+    'glam': [0.0, 0.0, 1.0, 0.0],
+    'experimental': [0.0, 0.0, 0.0, 1.0],
+}
+
+MAKEUP_FREQUENCY_MAPPING = {
+    'daily': [1.0, 0.0, 0.0, 0.0],
+    'few-times': [0.0, 1.0, 0.0, 0.0],
+    'occasionally': [0.0, 0.0, 1.0, 0.0],
+    'rarely': [0.0, 0.0, 0.0, 1.0],
+}
+
+# Position of each concern within the 6-slot restrictions section
+CONCERN_MAPPING = {
+    'acne': 0, 'aging': 1, 'dark-spots': 2,
+    'redness': 3, 'pores': 4, 'texture': 5,
+}
+
+# Where each one-hot style field lives in the embedding: (field, offset, mapping)
+EMBEDDING_LAYOUT = [
+    ('skin_tone', 0, SKIN_TONE_MAPPING),
+    ('under_tone', 10, UNDERTONE_MAPPING),
+    ('coverage_level', 20, COVERAGE_MAPPING),
+    ('skin_type', 30, SKIN_TYPE_MAPPING),
+    ('lip_product', 50, LIP_PRODUCT_MAPPING),
+    ('makeup_style', 60, MAKEUP_STYLE_MAPPING),
+    ('makeup_frequency', 70, MAKEUP_FREQUENCY_MAPPING),
+]
+CONCERNS_OFFSET = 40
+
 # Feature weights to emphasize important attributes
 FEATURE_WEIGHTS = {
     'skin_tone': 2.0,      # Very important
@@ -96,122 +191,506 @@ FEATURE_WEIGHTS = {
     'makeup_frequency': 0.5, # Less important
 }
 
+class CompiledEncoder:
+    """
+    Quiz-to-embedding encoder with every weighted sub-vector built once up
+    front. Encoding is a handful of slice assignments from cached arrays,
+    and since the quiz only has a finite number of answer combinations the
+    finished vectors are memoized on the normalized answers.
+    """
+
+    def __init__(self, weights: Dict[str, float] = FEATURE_WEIGHTS, cache_size: int = 4096):
+        self.sections = []
+        for field, offset, mapping in EMBEDDING_LAYOUT:
+            weight = weights.get(field, 1.0)
+            vectors = {
+                value: np.asarray(vector, dtype=np.float64) * weight
+                for value, vector in mapping.items()
+            }
+            self.sections.append((field, offset, vectors))
+
+        # Row 0 of every table is the zero vector used for unknown answers,
+        # which lets encode_batch gather a whole column of answers at once
+        self.tables = []
+        for field, offset, vectors in self.sections:
+            rows = {value: i + 1 for i, value in enumerate(vectors)}
+            width = len(next(iter(vectors.values())))
+            table = np.zeros((len(vectors) + 1, width))
+            for value, row in rows.items():
+                table[row] = vectors[value]
+            self.tables.append((offset, rows, table))
+
+        self.concern_weight = weights.get('restrictions', 1.0)
+        self.encode_key = lru_cache(maxsize=cache_size)(self._encode_key)
+
+    def normalize(self, quiz_result: QuizResult) -> tuple:
+        """Reduce quiz answers to a hashable key; unknown answers become ''."""
+        key = []
+        for field, _, vectors in self.sections:
+            value = getattr(quiz_result, field).lower()
+            key.append(value if value in vectors else '')
+
+        concerns = set()
+        if quiz_result.restrictions:
+            for concern in quiz_result.restrictions.split(','):
+                concern = concern.strip().lower()
+                if concern in CONCERN_MAPPING:
+                    concerns.add(concern)
+        key.append(tuple(sorted(concerns)))
+        return tuple(key)
+
+    def _encode_key(self, key: tuple) -> np.ndarray:
+        embedding = np.zeros(VECTOR_SIZE)
+        for (_, offset, vectors), value in zip(self.sections, key):
+            if value:
+                vector = vectors[value]
+                embedding[offset:offset + len(vector)] = vector
+
+        for concern in key[-1]:
+            embedding[CONCERNS_OFFSET + CONCERN_MAPPING[concern]] = self.concern_weight
+
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding /= norm
+
+        # Cached arrays are shared between callers, so make them read-only
+        embedding.flags.writeable = False
+        return embedding
+
+    def encode(self, quiz_result: QuizResult) -> np.ndarray:
+        return self.encode_key(self.normalize(quiz_result))
+
+    def encode_batch(self, quiz_results: List[QuizResult]) -> np.ndarray:
+        """
+        Encode many quiz results into an (N, VECTOR_SIZE) matrix in one
+        vectorized pass: per-field index gathers from the weighted tables,
+        a multi-hot block for concerns, and row-wise normalization.
+        """
+        keys = [self.normalize(quiz_result) for quiz_result in quiz_results]
+        embeddings = np.zeros((len(keys), VECTOR_SIZE))
+        if not keys:
+            return embeddings
+
+        for column, (offset, rows, table) in enumerate(self.tables):
+            indices = np.fromiter((rows.get(key[column], 0) for key in keys), dtype=np.intp, count=len(keys))
+            embeddings[:, offset:offset + table.shape[1]] = table[indices]
+
+        concern_rows = []
+        concern_cols = []
+        for i, key in enumerate(keys):
+            for concern in key[-1]:
+                concern_rows.append(i)
+                concern_cols.append(CONCERNS_OFFSET + CONCERN_MAPPING[concern])
+        embeddings[concern_rows, concern_cols] = self.concern_weight
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings /= norms
+        return embeddings
+
+compiled_encoder = CompiledEncoder()
+
 def generate_semantic_embedding(quiz_result: QuizResult) -> List[float]:
     """
     Generate a semantic embedding for user quiz results with the same
     structure as product embeddings for better matching.
     """
-    # Initialize a zero vector
-    embedding = np.zeros(VECTOR_SIZE)
-    
-    # Helper function to fill a section of the embedding
-    def fill_section(start_idx, values, weight=1.0):
-        if values is None:
-            return False
-        
-        length = len(values)
-        embedding[start_idx:start_idx+length] = np.array(values) * weight
-        return True
-    
-    # Extract and map skin tone information
-    skin_tone_idx = 0
-    skin_tone = quiz_result.skin_tone.lower()
-    if skin_tone in SKIN_TONE_MAPPING:
-        embedding[skin_tone_idx:skin_tone_idx+6] = np.array(SKIN_TONE_MAPPING[skin_tone]) * FEATURE_WEIGHTS.get('skin_tone', 1.0)
-        logger.info(f"Set skin tone: {skin_tone}")
-    
-    # Extract and map undertone information
-    undertone_idx = 10
-    undertone = quiz_result.under_tone.lower()
-    if undertone in UNDERTONE_MAPPING:
-        embedding[undertone_idx:undertone_idx+3] = np.array(UNDERTONE_MAPPING[undertone]) * FEATURE_WEIGHTS.get('under_tone', 1.0)
-        logger.info(f"Set undertone: {undertone}")
-    
-    # Extract and map coverage information
-    coverage_idx = 20
-    coverage = quiz_result.coverage_level.lower()
-    if coverage in COVERAGE_MAPPING:
-        embedding[coverage_idx:coverage_idx+3] = np.array(COVERAGE_MAPPING[coverage]) * FEATURE_WEIGHTS.get('coverage_level', 1.0)
-        logger.info(f"Set coverage level: {coverage}")
-    
-    # Extract and map skin type information
-    skin_type_idx = 30
-    skin_type = quiz_result.skin_type.lower()
-    if skin_type in SKIN_TYPE_MAPPING:
-        embedding[skin_type_idx:skin_type_idx+4] = np.array(SKIN_TYPE_MAPPING[skin_type]) * FEATURE_WEIGHTS.get('skin_type', 1.0)
-        logger.info(f"Set skin type: {skin_type}")
-    
-    # Extract concerns/restrictions
-    concerns_idx = 40
-    if quiz_result.restrictions:
-        concern_vec = np.zeros(6)  # 6 possible concerns in quiz
-        concerns = quiz_result.restrictions.split(',')
-        
-        # Map concerns to vector positions
-        concern_mapping = {
-            'acne': 0, 'aging': 1, 'dark-spots': 2, 
-            'redness': 3, 'pores': 4, 'texture': 5
-        }
-        
-        for concern in concerns:
-            concern = concern.strip().lower()
-            if concern in concern_mapping:
-                concern_vec[concern_mapping[concern]] = 1.0
-                logger.info(f"Added concern: {concern}")
-        
-        embedding[concerns_idx:concerns_idx+6] = concern_vec * FEATURE_WEIGHTS.get('restrictions', 1.0)
-    
-    # Extract lip product preference
-    lip_idx = 50
-    lip_mapping = {
-        'lipstick': [1.0, 0.0, 0.0, 0.0],
-        'gloss': [0.0, 1.0, 0.0, 0.0],
-        'stain': [0.0, 0.0, 1.0, 0.0],
-        'balm': [0.0, 0.0, 0.0, 1.0]
-    }
-    lip_product = quiz_result.lip_product.lower()
-    if lip_product in lip_mapping:
-        embedding[lip_idx:lip_idx+4] = np.array(lip_mapping[lip_product]) * FEATURE_WEIGHTS.get('lip_product', 0.5)
-        logger.info(f"Set lip product: {lip_product}")
-    
-    # Extract makeup style
-    style_idx = 60
-    style_mapping = {
-        'natural': [1.0, 0.0, 0.0, 0.0],
-        'minimal': [0.7, 0.3, 0.0, 0.0],
-        'glam': [0.0, 0.0, 1.0, 0.0],
-        'experimental': [0.0, 0.0, 0.0, 1.0]
-    }
-    makeup_style = quiz_result.makeup_style.lower()
-    if makeup_style in style_mapping:
-        embedding[style_idx:style_idx+4] = np.array(style_mapping[makeup_style]) * FEATURE_WEIGHTS.get('makeup_style', 0.8)
-        logger.info(f"Set makeup style: {makeup_style}")
-    
-    # Extract makeup frequency
-    freq_idx = 70
-    freq_mapping = {
-        'daily': [1.0, 0.0, 0.0, 0.0],
-        'few-times': [0.0, 1.0, 0.0, 0.0],
-        'occasionally': [0.0, 0.0, 1.0, 0.0],
-        'rarely': [0.0, 0.0, 0.0, 1.0]
-    }
-    frequency = quiz_result.makeup_frequency.lower()
-    if frequency in freq_mapping:
-        embedding[freq_idx:freq_idx+4] = np.array(freq_mapping[frequency]) * FEATURE_WEIGHTS.get('makeup_frequency', 0.5)
-        logger.info(f"Set makeup frequency: {frequency}")
-    
-    # Normalize the embedding
-    norm = np.linalg.norm(embedding)
-    if norm > 0:
-        embedding = embedding / norm
-    
-    # Log some stats about the embedding
-    num_nonzero = np.count_nonzero(embedding)
-    logger.info(f"Generated embedding with {num_nonzero} non-zero values out of {VECTOR_SIZE}")
-    logger.info(f"First 10 values: {embedding[:10]}")
-    
+    embedding = compiled_encoder.encode(quiz_result)
+    logger.debug(f"Generated embedding with {np.count_nonzero(embedding)} non-zero values out of {VECTOR_SIZE}")
     return embedding.tolist()
 
+def parse_embedding(embedding) -> Optional[np.ndarray]:
+    """
+    Convert an embedding as stored in Supabase into a float32 vector.
+    pgvector columns come back as strings like "[0.1,0.2]", plain array
+    columns as lists, and some rows as {index: value} objects.
+    """
+    if embedding is None:
+        return None
+    if isinstance(embedding, str):
+        try:
+            embedding = json.loads(embedding)
+        except ValueError:
+            return None
+    if isinstance(embedding, dict):
+        embedding = list(embedding.values())
+    try:
+        vector = np.asarray(embedding, dtype=np.float32)
+    except (TypeError, ValueError):
+        return None
+    if vector.ndim != 1 or vector.size == 0 or not np.all(np.isfinite(vector)):
+        return None
+    return vector
+
+def embedding_matrix(rows: List[Dict]):
+    """
+    Turn blush_embeddings rows into an id array and a float32 matrix. Rows
+    are zero-padded to the widest embedding so one matrix holds them all.
+    """
+    ids = []
+    vectors = []
+    for row in rows:
+        vector = parse_embedding(row.get("embedding"))
+        if vector is None:
+            logger.warning(f"Skipping unparseable embedding for blush_id {row.get('blush_id')}")
+            continue
+        ids.append(row["blush_id"])
+        vectors.append(vector)
+
+    dimension = max((len(v) for v in vectors), default=VECTOR_SIZE)
+    matrix = np.zeros((len(vectors), dimension), dtype=np.float32)
+    for i, vector in enumerate(vectors):
+        matrix[i, :len(vector)] = vector
+
+    return np.asarray(ids, dtype=np.int64), matrix
+
+def encode_embeddings_binary(ids: np.ndarray, matrix: np.ndarray, quantize: Optional[str] = None) -> bytes:
+    """
+    Pack embeddings into the compact wire format served to clients that
+    send Accept: application/octet-stream. Everything is little-endian:
+
+      float32: int32 ids[n], float32 values[n * d]
+      int8:    int32 ids[n], float32 scales[n], int8 values[n * d]
+
+    With int8 quantization each row is value = int8 * scale.
+    """
+    parts = [ids.astype("<i4").tobytes()]
+    if quantize == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.zeros(0, dtype=np.float32)
+        scales[scales == 0] = 1.0
+        quantized = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+        parts.append(scales.astype("<f4").tobytes())
+        parts.append(quantized.tobytes())
+    else:
+        parts.append(matrix.astype("<f4").tobytes())
+    return b"".join(parts)
+
+class ProductIndex:
+    """
+    In-memory index of L2-normalized product embeddings. Ranking a query is
+    a single matrix-vector product followed by argpartition, so the
+    response only ever carries k results.
+    """
+
+    def __init__(self):
+        # (ids, matrix), replaced as one pair so a query never mixes two builds
+        self.vectors = (np.zeros(0, dtype=np.int64), np.zeros((0, VECTOR_SIZE), dtype=np.float32))
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.vectors[0])
+
+    def build(self, rows: List[Dict]):
+        ids, matrix = embedding_matrix(rows)
+        dimension = matrix.shape[1]
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+
+        self.vectors = (ids, matrix)
+        self.loaded = True
+        logger.info(f"Built product index with {len(ids)} vectors of dimension {dimension}")
+
+    def load(self):
+        self.build(fetch_all_rows("blush_embeddings", "blush_id, embedding", key="blush_id"))
+
+    def query(self, embedding, k: int) -> List[Dict]:
+        ids, matrix = self.vectors
+        if len(ids) == 0:
+            return []
+
+        # Match the query to the index dimension, truncating or zero-padding
+        dimension = matrix.shape[1]
+        query = np.zeros(dimension, dtype=np.float32)
+        embedding = np.asarray(embedding, dtype=np.float32)[:dimension]
+        query[:len(embedding)] = embedding
+
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query /= norm
+
+        scores = matrix @ query
+        k = min(k, len(scores))
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [
+            {"blush_id": int(ids[i]), "score": float(scores[i])}
+            for i in top
+        ]
+
+product_index = ProductIndex()
+
+async def ensure_product_index():
+    """Load the product index if it is missing or was invalidated, once for all waiting requests"""
+    if product_index.loaded:
+        return
+    async with product_index.lock:
+        if not product_index.loaded:
+            await run_blocking(product_index.load)
+
+class CacheEntry:
+    def __init__(self, body: bytes, expires_at: float, media_type: str, headers: Optional[Dict[str, str]] = None):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.expires_at = expires_at
+        self.media_type = media_type
+        self.headers = headers or {}
+
+class ResponseCache:
+    """
+    Process-local TTL cache of serialized JSON responses with LRU eviction.
+    Keys are tuples whose first element names the endpoint, so a whole
+    endpoint can be invalidated at once.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[CacheEntry]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: tuple, body: bytes, media_type: str = "application/json",
+            headers: Optional[Dict[str, str]] = None) -> CacheEntry:
+        entry = CacheEntry(body, time.monotonic() + self.ttl, media_type, headers)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, scope: Optional[str] = None) -> int:
+        with self.lock:
+            if scope is None:
+                removed = len(self.entries)
+                self.entries.clear()
+                return removed
+            keys = [key for key in self.entries if key[0] == scope]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "300"))
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "256"))
+CACHE_INVALIDATE_TOKEN = os.getenv("CACHE_INVALIDATE_TOKEN")
+CACHE_SCOPES = ("products", "product-embeddings")
+
+response_cache = ResponseCache(PRODUCT_CACHE_TTL, PRODUCT_CACHE_SIZE)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Relative importance of each product field when ranking search results
+SEARCH_FIELD_WEIGHTS = {
+    'name': 3.0,
+    'brand': 2.0,
+    'type': 1.0,
+    'color': 1.0,
+}
+PREFIX_MATCH_WEIGHT = 0.7
+FUZZY_MATCH_WEIGHT = 0.5
+FUZZY_MIN_LENGTH = 4
+MAX_PREFIX_EXPANSIONS = 50
+SEARCH_DEFAULT_LIMIT = 50
+
+# Largest page /products will return when a limit is given
+PRODUCTS_MAX_LIMIT = 500
+FIELD_NAME_PATTERN = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+async def cached_response(request: Request, key: tuple, build, vary: Optional[str] = None) -> Response:
+    """
+    Serve a response body from the response cache, calling `build` to produce
+    (body, media_type, headers) on a miss. Replies 304 when the client's
+    If-None-Match still matches.
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        body, media_type, extra_headers = await build()
+        entry = response_cache.set(key, body, media_type, extra_headers)
+
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if vary:
+        headers["Vary"] = vary
+    if_none_match = request.headers.get("if-none-match", "")
+    if entry.etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    headers.update(entry.headers)
+    return Response(content=entry.body, media_type=entry.media_type, headers=headers)
+
+async def cached_json_response(request: Request, key: tuple, build) -> Response:
+    """Like cached_response, for a `build` that returns a JSON-serializable payload"""
+    async def build_json():
+        payload = await build()
+        return json.dumps(payload).encode(), "application/json", None
+
+    return await cached_response(request, key, build_json)
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, strip accents and split into alphanumeric tokens"""
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return TOKEN_PATTERN.findall(text.lower())
+
+def deletion_variants(token: str) -> set:
+    """Every string obtained by deleting one character, plus the token itself"""
+    return {token} | {token[:i] + token[i + 1:] for i in range(len(token))}
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance with adjacent transpositions, cut off above `limit`"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+class SearchIndex:
+    """
+    In-process inverted index over product name, brand, type and color.
+    Query terms match exactly, as a prefix, or within one typo (found via a
+    deletion-variant map), and results are ranked by field-weighted score.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.products = []
+        self.postings = {}
+        self.vocabulary = []
+        self.deletions = {}
+        self.built_at = None
+        self.lock = asyncio.Lock()
+
+    def is_stale(self) -> bool:
+        return self.built_at is None or time.monotonic() - self.built_at > self.ttl
+
+    def invalidate(self):
+        self.built_at = None
+
+    def build(self, products: List[Dict]):
+        postings = {}
+        for doc, product in enumerate(products):
+            for field, weight in SEARCH_FIELD_WEIGHTS.items():
+                value = product.get(field)
+                if not value:
+                    continue
+                for token in tokenize(str(value)):
+                    scores = postings.setdefault(token, {})
+                    scores[doc] = max(scores.get(doc, 0.0), weight)
+
+        deletions = {}
+        for token in postings:
+            if len(token) >= FUZZY_MIN_LENGTH:
+                for variant in deletion_variants(token):
+                    deletions.setdefault(variant, set()).add(token)
+
+        self.products = products
+        self.postings = postings
+        self.vocabulary = sorted(postings)
+        self.deletions = deletions
+        self.built_at = time.monotonic()
+        logger.info(f"Built search index with {len(products)} products and {len(postings)} terms")
+
+    def expand(self, term: str) -> Dict[str, float]:
+        """Map a query term to the indexed tokens it matches and their match quality"""
+        matches = {}
+        if term in self.postings:
+            matches[term] = 1.0
+
+        start = bisect.bisect_left(self.vocabulary, term)
+        for token in itertools.islice(self.vocabulary, start, start + MAX_PREFIX_EXPANSIONS):
+            if not token.startswith(term):
+                break
+            matches.setdefault(token, PREFIX_MATCH_WEIGHT)
+
+        if not matches and len(term) >= FUZZY_MIN_LENGTH:
+            for variant in deletion_variants(term):
+                for token in self.deletions.get(variant, ()):
+                    if token not in matches and edit_distance(term, token, 1) <= 1:
+                        matches[token] = FUZZY_MATCH_WEIGHT
+        return matches
+
+    def search(self, query: str, category: Optional[str] = None, offset: int = 0, limit: int = 50):
+        """
+        Find products matching every query term. Returns the total number of
+        matches and the requested page of products, best first.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return 0, []
+
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for token, quality in self.expand(term).items():
+                for doc, weight in self.postings[token].items():
+                    score = weight * quality
+                    if score > term_scores.get(doc, 0.0):
+                        term_scores[doc] = score
+
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc: score + term_scores[doc] for doc, score in scores.items() if doc in term_scores}
+            if not scores:
+                return 0, []
+
+        if category:
+            scores = {doc: score for doc, score in scores.items() if self.products[doc].get('category') == category}
+
+        # Only the requested page needs ordering, not every match
+        top = heapq.nsmallest(offset + limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return len(scores), [self.products[doc] for doc, _ in top[offset:]]
+
+search_index = SearchIndex(PRODUCT_CACHE_TTL)
+
+async def ensure_search_index():
+    """Rebuild the search index from the full catalog when it is missing or stale"""
+    if not search_index.is_stale():
+        return
+    async with search_index.lock:
+        if not search_index.is_stale():
+            return
+        search_index.build(await run_blocking(fetch_all_rows, "products"))
+
+class RecommendRequest(BaseModel):
+    quiz: Optional[QuizResult] = None
+    embedding: Optional[List[float]] = None
+    k: int = Field(default=10, ge=1, le=100)
+
+@app.on_event("startup")
+async def load_product_index():
+    try:
+        await ensure_product_index()
+    except Exception as e:
+        # Don't refuse to start; /recommend retries the load on first use
+        logger.error(f"Error loading product index: {str(e)}")
+
 @app.post("/generate-embedding")
 async def generate_embedding(quiz_result: Dict):
     try:
@@ -242,51 +721,253 @@ async def generate_embedding(quiz_result: Dict):
         tb = traceback.format_exc()
         logger.error(f"Stack trace: {tb}")
         raise HTTPException(status_code=500, detail=f"Failed to generate embedding: {str(e)}")
-    
-@app.get("/products")
-async def get_products(category: Optional[str] = None, search: Optional[str] = None):
+
+@app.post("/generate-embeddings:batch")
+async def generate_embeddings_batch(quiz_results: List[QuizResult], request: Request):
+    if len(quiz_results) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch size is limited to {MAX_BATCH_SIZE} quiz results")
+
     try:
+        embeddings = compiled_encoder.encode_batch(quiz_results)
+
+        # Backfill jobs can ask for raw little-endian float32 rows instead of JSON
+        if "application/octet-stream" in request.headers.get("accept", ""):
+            return Response(
+                content=embeddings.astype("<f4").tobytes(),
+                media_type="application/octet-stream",
+                headers={
+                    "X-Embedding-Count": str(embeddings.shape[0]),
+                    "X-Embedding-Dimension": str(embeddings.shape[1]),
+                }
+            )
+
+        return {
+            "status": "success",
+            "embeddings": embeddings.tolist(),
+            "meta": {
+                "count": embeddings.shape[0],
+                "dimension": embeddings.shape[1],
+                "timestamp": __import__('datetime').datetime.now().isoformat()
+            }
+        }
+
+    except Exception as e:
+        logger.error(f"Error generating batch embeddings: {str(e)}")
+        tb = traceback.format_exc()
+        logger.error(f"Stack trace: {tb}")
+        raise HTTPException(status_code=500, detail=f"Failed to generate embeddings: {str(e)}")
+
+@app.post("/recommend")
+async def recommend(request: RecommendRequest):
+    if request.embedding is None and request.quiz is None:
+        raise HTTPException(status_code=422, detail="Provide either quiz answers or an embedding")
+
+    try:
+        await ensure_product_index()
+
+        if request.embedding is not None:
+            embedding = request.embedding
+        else:
+            embedding = compiled_encoder.encode(request.quiz)
+
+        results = product_index.query(embedding, request.k)
+
+        return {
+            "status": "success",
+            "recommendations": results,
+            "meta": {
+                "k": request.k,
+                "indexed_products": len(product_index),
+            }
+        }
+
+    except Exception as e:
+        logger.error(f"Error generating recommendations: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to generate recommendations")
+
+# Columns of the products table, read from a row the first time fields= is used
+product_columns: Optional[frozenset] = None
+
+async def load_product_columns() -> Optional[frozenset]:
+    """The products table's columns, or None while the table is empty"""
+    global product_columns
+    if product_columns is None:
+        response = await run_blocking(supabase.table("products").select("*").limit(1).execute)
+        rows = response.data if hasattr(response, 'data') and response.data else []
+        if rows:
+            product_columns = frozenset(rows[0])
+    return product_columns
+
+def parse_fields(fields: Optional[str], known_columns: Optional[frozenset] = None) -> Optional[List[str]]:
+    """
+    Parse a comma-separated fields= projection. The id column is always
+    included because it doubles as the pagination cursor. Names outside
+    known_columns are rejected here rather than failing in PostgREST.
+    """
+    if not fields:
+        return None
+    columns = ['id']
+    for field in fields.split(','):
+        field = field.strip()
+        if not field:
+            continue
+        if not FIELD_NAME_PATTERN.match(field):
+            raise HTTPException(status_code=400, detail=f"Invalid field name: {field}")
+        if known_columns is not None and field not in known_columns:
+            raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+        if field not in columns:
+            columns.append(field)
+    return columns
+
+@app.get("/products")
+async def get_products(
+    request: Request,
+    category: Optional[str] = None,
+    search: Optional[str] = None,
+    fields: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: Optional[int] = Query(default=None, ge=1, le=PRODUCTS_MAX_LIMIT),
+    offset: int = Query(default=0, ge=0),
+):
+    """
+    List products, or search them when `search` is given. Listings are
+    ordered by id and paginated by keyset: pass the returned next_cursor
+    back as `cursor`. Searches are ranked and paginated with offset.
+    `fields` limits each product to the given columns.
+    """
+    if category == 'all':
+        category = None
+    columns = parse_fields(fields, await load_product_columns() if fields else None)
+
+    async def fetch_products():
+        select = ",".join(columns) if columns else "*"
+        if limit is None:
+            # No page size requested: return the whole listing, paged past PostgREST's row cap
+            products = await run_blocking(fetch_all_rows, "products", select, "id", SUPABASE_PAGE_SIZE,
+                                          {'category': category} if category else None, cursor)
+            return {"products": products, "next_cursor": None}
+
         # Fetch products from Supabase
-        query = supabase.table("products").select("*")
+        query = supabase.table("products").select(select)
         
         # Apply category filter if provided
-        if category and category != 'all':
+        if category:
             query = query.eq('category', category)
+
+        # Keyset pagination on id; one extra row tells us whether another page exists
+        query = query.order('id')
+        if cursor is not None:
+            query = query.gt('id', cursor)
+        query = query.limit(limit + 1)
         
-        # Apply search filter if provided
+        response = await run_blocking(query.execute)
+        products = response.data if hasattr(response, 'data') and response.data else []
+
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            next_cursor = products[-1]['id']
+
+        return {"products": products, "next_cursor": next_cursor}
+
+    async def search_products():
+        # Searches are served from the in-process index, ranked and paginated
+        await ensure_search_index()
+        page_size = limit or SEARCH_DEFAULT_LIMIT
+        total, products = search_index.search(search, category, offset, page_size)
+        if columns:
+            products = [{column: product.get(column) for column in columns} for product in products]
+        return {
+            "products": products,
+            "total": total,
+            "offset": offset,
+            "limit": page_size,
+        }
+
+    try:
         if search:
-            query = query.ilike('name', f'%{search}%')
-        
-        response = query.execute()
-        
-        if hasattr(response, 'data'):
-            return {"products": response.data}
-        else:
-            return {"products": []}
+            key = ("products", category, search.strip().lower(), fields, offset, limit)
+            return await cached_json_response(request, key, search_products)
+        return await cached_json_response(request, ("products", category, fields, cursor, limit), fetch_products)
     
     except Exception as e:
         logger.error(f"Error fetching products: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to fetch products")
 
 @app.get("/product-embeddings")
-async def get_product_embeddings():
-    try:
+async def get_product_embeddings(request: Request, quantize: Optional[str] = None):
+    """
+    Product embeddings as JSON by default. Clients sending
+    Accept: application/octet-stream get the packed binary format from
+    encode_embeddings_binary instead, optionally int8-quantized.
+    """
+    binary = "application/octet-stream" in request.headers.get("accept", "")
+    if quantize is not None and quantize != "int8":
+        raise HTTPException(status_code=400, detail=f"Unsupported quantization: {quantize}")
+
+    async def fetch_rows():
         # Fetch all product embeddings
-        response = supabase.table("blush_embeddings").select("blush_id, embedding").execute()
-        
-        if hasattr(response, 'data'):
-            return {"embeddings": response.data}
-        else:
-            return {"embeddings": []}
+        return await run_blocking(fetch_all_rows, "blush_embeddings", "blush_id, embedding", "blush_id")
+
+    async def build_json():
+        rows = await fetch_rows()
+        return json.dumps({"embeddings": rows}).encode(), "application/json", None
+
+    async def build_binary():
+        ids, matrix = embedding_matrix(await fetch_rows())
+        headers = {
+            "X-Embedding-Count": str(matrix.shape[0]),
+            "X-Embedding-Dimension": str(matrix.shape[1]),
+            "X-Embedding-Format": quantize or "float32",
+        }
+        return encode_embeddings_binary(ids, matrix, quantize), "application/octet-stream", headers
+
+    try:
+        if binary:
+            key = ("product-embeddings", "binary", quantize or "float32")
+            return await cached_response(request, key, build_binary, vary="Accept")
+        return await cached_response(request, ("product-embeddings", "json"), build_json, vary="Accept")
     
     except Exception as e:
         logger.error(f"Error fetching product embeddings: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to fetch product embeddings")
 
+@app.post("/cache/invalidate")
+async def invalidate_cache(authorization: Optional[str] = Header(default=None), scope: Optional[str] = None):
+    """
+    Drop cached catalog responses. Called by the scraper and the embedding
+    job once they finish writing to Supabase.
+    """
+    if not CACHE_INVALIDATE_TOKEN:
+        raise HTTPException(status_code=503, detail="Cache invalidation is not configured")
+
+    token = authorization[len("Bearer "):] if authorization and authorization.startswith("Bearer ") else ""
+    if not hmac.compare_digest(token.encode(), CACHE_INVALIDATE_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid cache invalidation token")
+
+    if scope is not None and scope not in CACHE_SCOPES:
+        raise HTTPException(status_code=400, detail=f"Unknown cache scope: {scope}")
+
+    removed = response_cache.invalidate(scope)
+
+    if scope in (None, "products"):
+        search_index.invalidate()
+
+    # New embeddings also mean the recommendation index is stale
+    if scope in (None, "product-embeddings"):
+        product_index.loaded = False
+
+    logger.info(f"Invalidated {removed} cached responses (scope: {scope or 'all'})")
+    return {"status": "success", "invalidated": removed}
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.on_event("shutdown")
+def shutdown_supabase_executor():
+    supabase_executor.shutdown(wait=False)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file